@@ -1,12 +1,21 @@
 import re
+from functools import lru_cache
+
+# Upper bound on the number of distinct compiled patterns kept in memory.
+COMPILED_PATTERN_CACHE_SIZE = 8192
 
 class MqttPatternMatcher:
     """
     A model to detect if a given MQTT topic matches or conflicts with existing 
     topic patterns, supporting single-level (+) and multi-level (#) wildcards.
+
+    Patterns are translated and compiled once and kept in a bounded LRU cache
+    shared by every instance, so repeated checks against the same patterns
+    cost a single compiled match each.
     """
 
-    def _pattern_to_regex(self, pattern: str) -> str:
+    @staticmethod
+    def _pattern_to_regex(pattern: str) -> str:
         """
         Converts an MQTT topic pattern with wildcards into a regular expression.
 
@@ -16,22 +25,81 @@ class MqttPatternMatcher:
         Returns:
             str: A regular expression string for matching.
         """
-        # Replace single-level wildcard '+' with a regex part that matches any characters
-        # except the topic level separator '/'.
-        regex = pattern.replace('+', '[^/]+')
+        # If the pattern is just '#', it matches everything.
+        if pattern == '#':
+            return '^.*$'
+
+        # If pattern is 'some/topic/#', it should match 'some/topic' and 'some/topic/...'
+        multi_level = pattern.endswith('/#')
+        if multi_level:
+            pattern = pattern[:-2]
+
+        # Only '+' and '#' are wildcards; every other character, '.' included,
+        # matches itself. Replace single-level wildcard '+' with a regex part
+        # that matches any characters except the topic level separator '/'.
+        regex = '[^/]+'.join(re.escape(part) for part in pattern.split('+'))
 
-        # Handle the multi-level wildcard '#'.
-        if regex.endswith('/#'):
-            # If pattern is 'some/topic/#', it should match 'some/topic' and 'some/topic/...'
+        if multi_level:
             # The '(?:/.*)?' part makes the slash and subsequent levels optional.
-            regex = regex[:-2] + '(?:/.*)?'
-        elif regex == '#':
-            # If the pattern is just '#', it matches everything.
-            regex = '.*'
-        
+            regex += '(?:/.*)?'
+
         # Anchor the regex to match the entire topic string.
         return f"^{regex}$"
 
+    @staticmethod
+    @lru_cache(maxsize=COMPILED_PATTERN_CACHE_SIZE)
+    def compile(pattern: str) -> re.Pattern:
+        """
+        Returns the compiled regular expression for an MQTT pattern.
+
+        Args:
+            pattern (str): The MQTT pattern (e.g., 'sensors/+/temp' or 'logs/#').
+
+        Returns:
+            re.Pattern: The compiled expression, cached across calls.
+        """
+        return re.compile(MqttPatternMatcher._pattern_to_regex(pattern))
+
+    def first_match(self, topic: str, pattern_list: list[str]) -> str | None:
+        """
+        Returns the first pattern in the list that matches the topic.
+
+        Args:
+            topic (str): The MQTT topic to check.
+            pattern_list (list[str]): Topic patterns that may include wildcards.
+
+        Returns:
+            str | None: The matching pattern, or None if nothing matched.
+        """
+        compile_pattern = self.compile
+        for pattern in pattern_list:
+            if compile_pattern(pattern).match(topic):
+                return pattern
+        return None
+
+    def match_many(self, topics: list[str], pattern_list: list[str]) -> dict:
+        """
+        Matches a batch of topics against a batch of patterns.
+
+        Every pattern is compiled at most once for the whole batch.
+
+        Args:
+            topics (list[str]): The MQTT topics to check.
+            pattern_list (list[str]): Topic patterns that may include wildcards.
+
+        Returns:
+            dict: Maps each topic to the first pattern that matched it, or None.
+        """
+        compiled = [(pattern, self.compile(pattern)) for pattern in pattern_list]
+        result = {}
+        for topic in topics:
+            result[topic] = None
+            for pattern, regex in compiled:
+                if regex.match(topic):
+                    result[topic] = pattern
+                    break
+        return result
+
     def is_match(self, topic: str, pattern_list: list[str]) -> dict:
         """
         Checks if the topic matches or overlaps with any pattern in the provided list.
@@ -43,15 +111,10 @@ class MqttPatternMatcher:
         Output:
             match (boolean): True if the topic matches or overlaps with any existing 
                              pattern, False otherwise.
+            pattern (string): The first pattern that matched, or None.
         """
-        for pattern in pattern_list:
-            regex_pattern = self._pattern_to_regex(pattern)
-            if re.match(regex_pattern, topic):
-                # If a match is found with any pattern, return immediately.
-                return {"match": True}
-        
-        # If no patterns matched after checking the whole list.
-        return {"match": False}
+        pattern = self.first_match(topic, pattern_list)
+        return {"match": pattern is not None, "pattern": pattern}
 
 if __name__ == "__main__":
     existing_patterns = [
@@ -87,4 +150,7 @@ if __name__ == "__main__":
     
     topic6 = "devices/bedroom/light/status"
     result6 = matcher.is_match(topic6, existing_patterns)
-    print(f"Topic: '{topic6}'\nResult: {result6}\n") # Expected: {'match': False}
\ No newline at end of file
+    print(f"Topic: '{topic6}'\nResult: {result6}\n") # Expected: {'match': False}
+
+    topics = [topic1, topic2, topic3, topic4, topic5, topic6]
+    print(f"Batch: {matcher.match_many(topics, existing_patterns)}\n")
\ No newline at end of file
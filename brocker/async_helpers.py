@@ -1,26 +1,39 @@
-from asgiref.sync import sync_to_async
 from brocker.MqttPatternMatcher import MqttPatternMatcher
 import logging
 
 logger = logging.getLogger(__name__)
 matcher = MqttPatternMatcher()
 
-@sync_to_async
-def get_broker_token(token_str):
+async def fetch_token_permissions(token_str):
+    """
+    Fetch a token and all of its permissions in a single query.
+
+    Returns (name, max_connections, [(prefix, (permission, tag_id)), ...]), or
+    None if the token does not exist.
+    """
     from .models import BrokerTokens
     logger.debug("Querying database for token: %s", token_str)
-    token_obj = BrokerTokens.objects.filter(token=token_str).first()
-    if token_obj:
-        logger.debug("Token found for: %s", token_str)
-    else:
+    rows = BrokerTokens.objects.filter(
+        token_hash=BrokerTokens.hash_token(token_str),
+        token=token_str,
+    ).values_list(
+        'name',
+        'max_connections',
+        'brokerpermission__tag__prefix',
+        'brokerpermission__permission',
+        'brokerpermission__tag_id',
+    )
+
+    name = max_connections = None
+    permissions_list = []
+    async for name, max_connections, prefix, permission, tag_id in rows:
+        # A token without permissions still yields one row from the outer join.
+        if prefix is not None:
+            permissions_list.append((prefix, (permission, tag_id)))
+
+    if max_connections is None:
         logger.debug("Token not found for: %s", token_str)
-    return token_obj
+        return None
 
-@sync_to_async
-def get_permissions(token_obj):
-    from .models import BrokerPermission
-    logger.debug("Querying permissions for token ID: %s", token_obj.id)
-    perms = BrokerPermission.objects.filter(broker=token_obj).select_related('tag')
-    permissions_list = [(p.tag.prefix, p.permission) for p in perms]
-    logger.debug("Found %d permissions for token ID: %s", len(permissions_list), token_obj.id)
-    return permissions_list
\ No newline at end of file
+    logger.debug("Found %d permissions for token: %s", len(permissions_list), token_str)
+    return name, max_connections, permissions_list
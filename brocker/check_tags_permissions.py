@@ -1,36 +1,100 @@
-from brocker.async_helpers import get_broker_token, get_permissions, matcher
+import asyncio
+
+from brocker.async_helpers import fetch_token_permissions
+from brocker.permission_cache import (
+    MISSING, TokenPermissions, listen_for_invalidations, permission_cache,
+)
+from brocker.topic_tree import TopicTree
+
+
+def build_permission_index(permissions):
+    """
+    Build a TopicTree of a token's permissions from
+    [(prefix, (permission, tag_id)), ...].
+    """
+    return TopicTree(permissions)
+
+
+# Reloads for an access change revision in flight: token -> (revision, task).
+_revision_loads = {}
+
+
+async def _load_token_permissions(token_str, generation, revision=None):
+    row = await fetch_token_permissions(token_str)
+    if row is None:
+        permission_cache.set(token_str, MISSING, generation, revision)
+        return None
+
+    name, max_connections, allowed_prefixes = row
+    entry = TokenPermissions(name, max_connections, build_permission_index(allowed_prefixes), revision)
+    permission_cache.set(token_str, entry, generation, revision)
+    return entry
+
+
+async def get_token_permissions(token_str, refresh=False, revision=None):
+    """
+    Return the TokenPermissions of a token, or None if the token does not exist.
+    Served from the worker's permission cache unless refresh is True.
+
+    With a revision (sent along with committed access changes), the entry is
+    reloaded unless it was already reloaded for that revision, and concurrent
+    callers share a single query.
+    """
+    await listen_for_invalidations()
+
+    if not refresh or revision is not None:
+        entry = permission_cache.get(token_str)
+        if entry is not None and (revision is None or (entry is not MISSING and entry.revision == revision)):
+            return None if entry is MISSING else entry
+
+    if revision is None:
+        return await _load_token_permissions(token_str, permission_cache.generation)
+
+    loading = _revision_loads.get(token_str)
+    if loading is None or loading[0] != revision:
+        # The revision is sent after its transaction committed, so the reload
+        # is stored even if the matching invalidation arrives meanwhile, but
+        # not after any other invalidation, which may be of a later change.
+        task = asyncio.ensure_future(
+            _load_token_permissions(token_str, permission_cache.generation, revision)
+        )
+        loading = _revision_loads[token_str] = (revision, task)
+
+        def forget(_, loading=loading):
+            if _revision_loads.get(token_str) is loading:
+                del _revision_loads[token_str]
+
+        task.add_done_callback(forget)
+    return await asyncio.shield(loading[1])
+
 
 async def check_tags_permissions(token_str, tags_str):
     """
     Check the token and tags, return a tuple:
-    ({ tag1: permission1, tag2: permission2, ... }, max_connections)
+    ({ tag1: permission1, tag2: permission2, ... }, max_connections, token_name,
+     { tag1: tag_id1, tag2: tag_id2, ... })
+    where tag_id is the BrokerTags row whose permission grants the tag.
     Returns None if token invalid or any tag not allowed.
     """
     # Split the tags by comma
     tags_list = [t.strip() for t in tags_str.split(',') if t.strip()]
 
-    # Fetch the token object
-    token_obj = await get_broker_token(token_str)
-    if not token_obj:
+    # Fetch the token and its permission index (cached per worker)
+    token_permissions = await get_token_permissions(token_str)
+    if not token_permissions:
         return None  # Token not found → reject
 
-    max_connections = token_obj.max_connections
-
-    # Fetch all allowed prefixes and permissions for this token
-    allowed_prefixes = await get_permissions(token_obj)
-    # allowed_prefixes = [(prefix, permission), ...]
+    token_name, max_connections, permission_index = token_permissions[:3]
 
     tag_permissions = {}
+    tag_ids = {}
 
     for tag in tags_list:
-        matched = False
-        for prefix, permission in allowed_prefixes:
-            if matcher.is_match(tag, [prefix])["match"]:
-                tag_permissions[tag] = permission
-                matched = True
-                break
-
-        if not matched:
+        # A wildcard tag must be covered by a grant, not merely matched by
+        # one as if it were a topic: 'sensors/+' does not grant 'sensors/#'.
+        found = permission_index.match_pattern(tag)
+        if found is None:
             return None
+        tag_permissions[tag], tag_ids[tag] = found[1]
 
-    return (tag_permissions, max_connections) if tag_permissions else None
+    return (tag_permissions, max_connections, token_name, tag_ids) if tag_permissions else None
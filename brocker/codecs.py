@@ -0,0 +1,272 @@
+import json
+import logging
+from functools import lru_cache
+
+from django.utils.module_loading import import_string
+
+from brocker.conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidFrame(ValueError):
+    """
+    Raised when an inbound frame is not a valid {tag, message, retain} envelope.
+    """
+
+
+# WebSocket subprotocol a client offers to exchange MessagePack frames.
+MSGPACK_SUBPROTOCOL = 'brocker.msgpack'
+
+
+class JsonCodec:
+    """
+    Encodes and decodes client frames with the standard library json module.
+
+    Subclasses swap in a faster implementation; they must produce and accept
+    the same wire format.
+    """
+    name = 'json'
+    # Whether frames travel as WebSocket binary (bytes) or text (str) frames.
+    binary = False
+
+    def dumps(self, obj) -> str:
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def encode_frame(self, tag, message, id=None) -> str:
+        envelope = {"tag": tag, "message": message}
+        if id is not None:
+            envelope["id"] = id
+        return self.dumps(envelope)
+
+    def join_frames(self, frames) -> str:
+        """
+        Combines already encoded frames into one array frame without
+        decoding them again.
+        """
+        return f"[{','.join(frames)}]"
+
+    def decode_envelopes(self, data, max_envelopes):
+        """
+        Decodes a frame holding either one envelope or an array of them.
+
+        Returns:
+            list: [(tag, message, retain), ...] in frame order.
+
+        Raises:
+            InvalidFrame: If the frame or any envelope in it is malformed, or
+                the array holds more than max_envelopes entries.
+        """
+        try:
+            decoded = self.loads(data)
+        except ValueError as exc:
+            raise InvalidFrame(f"invalid {self.name}: {exc}") from exc
+        return self._validate_many(decoded, max_envelopes)
+
+    def _validate_many(self, decoded, max_envelopes):
+        if isinstance(decoded, dict):
+            return [self._validate(decoded.get('tag'), decoded.get('message'), decoded.get('retain', False))]
+        if not isinstance(decoded, list) or not decoded:
+            raise InvalidFrame("frame is neither an envelope nor a non-empty array of envelopes")
+        if len(decoded) > max_envelopes:
+            raise InvalidFrame(f"batch of {len(decoded)} envelopes exceeds the limit of {max_envelopes}")
+
+        envelopes = []
+        for envelope in decoded:
+            if not isinstance(envelope, dict):
+                raise InvalidFrame("batch entry is not an envelope")
+            envelopes.append(
+                self._validate(envelope.get('tag'), envelope.get('message'), envelope.get('retain', False))
+            )
+        return envelopes
+
+    @staticmethod
+    def _validate(tag, message, retain=False):
+        if not isinstance(tag, str) or not tag:
+            raise InvalidFrame("missing or invalid 'tag'")
+        if message is None:
+            raise InvalidFrame("missing 'message'")
+        if not isinstance(retain, bool):
+            raise InvalidFrame("invalid 'retain'")
+        return tag, message, retain
+
+
+_SCALAR_TYPES = frozenset((str, int, float, bool, type(None)))
+
+
+def _contains_bytes(value):
+    # Subclasses count too: msgspec encodes namedtuples, such as msgpack's
+    # ExtType, as arrays and dict subclasses as objects.
+    if isinstance(value, dict):
+        items = value.values()
+    elif isinstance(value, (list, tuple)):
+        items = value
+    else:
+        return isinstance(value, (bytes, bytearray, memoryview))
+    for item in items:
+        if type(item) in _SCALAR_TYPES:
+            continue
+        if _contains_bytes(item):
+            return True
+    return False
+
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj) -> str:
+        return self._orjson.dumps(obj).decode()
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+class MsgspecCodec(JsonCodec):
+    """
+    Decodes envelopes straight into a typed struct, so malformed frames are
+    rejected by the parser without building an intermediate dict.
+    """
+    name = 'msgspec'
+
+    def __init__(self):
+        import msgspec
+        from typing import Any
+
+        class Envelope(msgspec.Struct):
+            tag: str
+            message: Any = None
+            retain: bool = False
+
+        self._msgspec = msgspec
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+        self._envelopes_decoder = msgspec.json.Decoder(Envelope | list[Envelope])
+
+    def dumps(self, obj) -> str:
+        return self._encoder.encode(obj).decode()
+
+    def loads(self, data):
+        return self._decoder.decode(data)
+
+    def encode_frame(self, tag, message, id=None) -> str:
+        # msgspec would base64-encode raw bytes; reject them like the other
+        # JSON codecs, so they only reach MessagePack clients.
+        if _contains_bytes(message):
+            raise TypeError("bytes are not JSON serializable")
+        return super().encode_frame(tag, message, id)
+
+    def decode_envelopes(self, data, max_envelopes):
+        try:
+            decoded = self._envelopes_decoder.decode(data)
+        except self._msgspec.DecodeError as exc:
+            raise InvalidFrame(str(exc)) from exc
+
+        if not isinstance(decoded, list):
+            return [self._validate(decoded.tag, decoded.message, decoded.retain)]
+        if not decoded:
+            raise InvalidFrame("empty batch")
+        if len(decoded) > max_envelopes:
+            raise InvalidFrame(f"batch of {len(decoded)} envelopes exceeds the limit of {max_envelopes}")
+        return [self._validate(envelope.tag, envelope.message, envelope.retain) for envelope in decoded]
+
+
+class MsgpackCodec(JsonCodec):
+    """
+    Binary frames for clients that negotiated MSGPACK_SUBPROTOCOL. The
+    envelope has the same {tag, message, retain} shape as the JSON one.
+    """
+    name = 'msgpack'
+    binary = True
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def dumps(self, obj) -> bytes:
+        return self._msgpack.packb(obj, use_bin_type=True)
+
+    def join_frames(self, frames) -> bytes:
+        count = len(frames)
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 0x10000:
+            header = b'\xdc' + count.to_bytes(2, 'big')
+        else:
+            header = b'\xdd' + count.to_bytes(4, 'big')
+        return header + b''.join(frames)
+
+    def loads(self, data):
+        try:
+            return self._msgpack.unpackb(data, raw=False)
+        except (ValueError, TypeError) as exc:
+            raise ValueError(str(exc)) from exc
+
+
+CODECS = {
+    'msgspec': MsgspecCodec,
+    'orjson': OrjsonCodec,
+    'json': JsonCodec,
+}
+
+
+@lru_cache(maxsize=None)
+def get_codec():
+    """
+    Returns the JSON codec selected by BROCKER_JSON_CODEC.
+    """
+    configured = get_setting('JSON_CODEC')
+    if configured == 'auto':
+        # msgspec and orjson are pinned in requirements.txt, so 'auto' only
+        # falls back to the standard library in incomplete installs.
+        for codec_class in CODECS.values():
+            try:
+                codec = codec_class()
+            except ImportError:
+                logger.warning("JSON codec '%s' is not installed", codec_class.name)
+                continue
+            logger.info("Using the '%s' JSON codec", codec.name)
+            return codec
+
+    codec_class = CODECS.get(configured) or import_string(configured)
+    return codec_class()
+
+
+@lru_cache(maxsize=None)
+def get_binary_codec():
+    """
+    Returns the codec for clients using MSGPACK_SUBPROTOCOL.
+    """
+    return MsgpackCodec()
+
+
+def frame_for(entry, tag, key):
+    """
+    Returns the frame of a message for clients of one wire format, 'text'
+    (JSON) or 'bytes' (MessagePack), or None if the message cannot be
+    represented in it, e.g. raw bytes published over MessagePack have no
+    JSON form.
+
+    entry holds the 'message' and, for messages kept for replay, its 'id'.
+    The frame is encoded on first use and cached in entry, so a worker
+    encodes each message at most once per format its subscribers use.
+    """
+    if key in entry:
+        return entry[key]
+    if 'message' not in entry:
+        # Pre-encoded by a publisher that predates lazy encoding.
+        return None
+    codec = get_binary_codec() if key == 'bytes' else get_codec()
+    try:
+        frame = codec.encode_frame(tag, entry['message'], entry.get('id'))
+    except (TypeError, ValueError, OverflowError) as exc:
+        logger.debug("Message on tag '%s' has no %s encoding: %s", tag, codec.name, exc)
+        frame = None
+    entry[key] = frame
+    return frame
@@ -0,0 +1,79 @@
+from django.conf import settings
+
+# Defaults for the BROCKER_* settings. Override any of them in the Django
+# settings module, e.g. BROCKER_PERMISSION_CACHE_TTL = 30.
+DEFAULTS = {
+    # Seconds a token's permissions stay cached in a worker process.
+    'PERMISSION_CACHE_TTL': 60,
+    # Maximum number of tokens cached per worker process.
+    'PERMISSION_CACHE_SIZE': 10000,
+    # Maximum number of unknown tokens cached per worker process, apart from
+    # the valid ones so that they cannot evict them.
+    'PERMISSION_CACHE_MISSING_SIZE': 1000,
+    # Redis used for connection accounting. When unset, connections are
+    # counted in-process, which is only correct for a single worker.
+    'REDIS_URL': None,
+    # Size of the async Redis connection pool per worker process.
+    'REDIS_MAX_CONNECTIONS': 50,
+    # Seconds a connection slot stays valid without a heartbeat. Slots held
+    # by a crashed worker free themselves after this long.
+    'CONNECTION_LEASE_TTL': 90,
+    # Seconds between bulk lease refreshes of a worker's open connections.
+    'CONNECTION_HEARTBEAT_INTERVAL': 30,
+    # JSON codec for client frames: 'auto' (msgspec, then orjson, then the
+    # standard library), 'msgspec', 'orjson', 'json', or a dotted path to a
+    # codec class.
+    'JSON_CODEC': 'auto',
+    # Frames buffered per connection while the client reads slower than
+    # messages arrive.
+    'OUTBOUND_QUEUE_SIZE': 1000,
+    # What to do when that buffer is full: 'drop_oldest', 'drop_newest',
+    # 'conflate' (keep only the latest pending frame per tag) or
+    # 'disconnect' (close the connection with code 4005).
+    'OUTBOUND_POLICY': 'drop_oldest',
+    # Opt-in outbound batching: messages on these tag patterns, or to tokens
+    # with these names, are sent as one array frame per batch. A batch is
+    # sent after BATCH_MAX_MESSAGES messages or BATCH_MAX_DELAY_MS
+    # milliseconds, whichever comes first.
+    'BATCH_TAGS': [],
+    'BATCH_TOKENS': [],
+    'BATCH_MAX_MESSAGES': 50,
+    'BATCH_MAX_DELAY_MS': 20,
+    # Most envelopes a client may publish in one array frame.
+    'PUBLISH_BATCH_MAX_ENVELOPES': 1000,
+    # Retained messages: the last message published with "retain": true on
+    # each tag is sent to clients subscribing to it later. Kept in Redis when
+    # BROCKER_REDIS_URL is set, else in-process. At most RETAINED_MAX_TAGS
+    # tags are kept (0 disables retained messages), the least recently
+    # retained are dropped first, and each expires RETAINED_TTL seconds
+    # after its last retained message (0 for never). Larger messages than
+    # RETAINED_MAX_BYTES are not retained.
+    'RETAINED_MAX_TAGS': 10000,
+    'RETAINED_TTL': 86400,
+    'RETAINED_MAX_BYTES': 65536,
+    # Tags whose retained message (or its absence) each worker keeps in an
+    # in-process LRU in front of Redis, and for how many seconds. Messages
+    # retained through another worker may go unseen for that long.
+    'RETAINED_CACHE_SIZE': 1000,
+    'RETAINED_CACHE_TTL': 1,
+    # Replay buffers: the last REPLAY_MAXLEN messages of each tag matching
+    # one of these patterns are kept (in a Redis stream when
+    # BROCKER_REDIS_URL is set, else in-process) for REPLAY_TTL seconds
+    # after the tag's last message. Messages on these tags carry an "id", and
+    # a client reconnecting with a Last-Id header gets the ones it missed,
+    # read REPLAY_BATCH_SIZE at a time and at most REPLAY_MAX_MESSAGES in
+    # total, before live messages.
+    'REPLAY_TAGS': [],
+    'REPLAY_MAXLEN': 1000,
+    'REPLAY_TTL': 3600,
+    'REPLAY_BATCH_SIZE': 100,
+    'REPLAY_MAX_MESSAGES': 10000,
+    # Seconds a route group (joined by wildcard subscribers) stays registered
+    # in Redis after the last refresh by a worker holding it. Publishes skip
+    # the route groups nobody registered; see brocker.routes.
+    'ROUTE_TTL': 90,
+}
+
+
+def get_setting(name):
+    return getattr(settings, f'BROCKER_{name}', DEFAULTS[name])
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import time
+
+from brocker.conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "connections:"
+
+# Connection slots are leases: members of a sorted set per token, scored by
+# their expiry time. Expired members are pruned before counting, so a slot
+# held by a worker that died frees itself once its lease runs out.
+#
+# KEYS[1] = lease set; ARGV = limit, lease ttl, lease id.
+# Returns the new count, or -1 if the limit was reached.
+ACQUIRE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local limit = tonumber(ARGV[1])
+local ttl = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local count = redis.call('ZCARD', KEYS[1])
+if limit > 0 and count >= limit then
+    return -1
+end
+redis.call('ZADD', KEYS[1], now + ttl, ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(ttl * 2))
+return count + 1
+"""
+
+# Extend the leases of one worker in a single call.
+# KEYS = lease set of each lease; ARGV = lease ttl, then one lease id per key.
+HEARTBEAT_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local ttl = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, 'XX', now + ttl, ARGV[i + 1])
+    redis.call('EXPIRE', key, math.ceil(ttl * 2))
+end
+return #KEYS
+"""
+
+# Prune expired leases of one token. Returns the number of live leases.
+RECONCILE_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'zset' then
+    redis.call('DEL', KEYS[1])
+    return 0
+end
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+return redis.call('ZCARD', KEYS[1])
+"""
+
+# Keys per heartbeat call, to keep each script run short.
+HEARTBEAT_BATCH_SIZE = 1000
+
+
+def counter_key(token):
+    from brocker.consumers import token_group
+    return f"{KEY_PREFIX}{token_group(token)}"
+
+
+class BaseConnectionCounter:
+    """
+    Tracks the connection slots held by this worker and refreshes them in
+    bulk from a background task, so that slots survive only as long as the
+    worker that holds them.
+    """
+
+    def __init__(self):
+        self.lease_ttl = get_setting('CONNECTION_LEASE_TTL')
+        self.heartbeat_interval = get_setting('CONNECTION_HEARTBEAT_INTERVAL')
+        self._leases = {}  # lease id -> lease set key
+        self._heartbeat_loop = None
+        self._heartbeat_task = None
+
+    def _start_heartbeat(self):
+        loop = asyncio.get_running_loop()
+        if self._heartbeat_loop is not loop:
+            self._heartbeat_loop = loop
+            self._heartbeat_task = loop.create_task(self._heartbeat_forever())
+
+    async def _heartbeat_forever(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            if not self._leases:
+                continue
+            try:
+                await self.heartbeat(list(self._leases.items()))
+            except Exception:
+                logger.exception("Failed to refresh %d connection leases", len(self._leases))
+
+    async def acquire(self, token, max_connections, lease):
+        """
+        Take a connection slot identified by lease. Returns the new count, or
+        None if the token is already at max_connections.
+        """
+        key = counter_key(token)
+        count = await self._acquire(key, max_connections, lease)
+        if count is None:
+            return None
+        self._leases[lease] = key
+        self._start_heartbeat()
+        return count
+
+    async def release(self, token, lease):
+        """
+        Give a connection slot back. Returns the remaining count.
+        """
+        key = self._leases.pop(lease, None) or counter_key(token)
+        return await self._release(key, lease)
+
+
+class RedisConnectionCounter(BaseConnectionCounter):
+    """
+    Keeps connection leases in Redis using a native async client, so the
+    check never blocks the event loop.
+    """
+
+    def __init__(self, url, max_connections):
+        super().__init__()
+        from redis.asyncio import BlockingConnectionPool, Redis
+        self._redis = Redis(connection_pool=BlockingConnectionPool.from_url(url, max_connections=max_connections))
+        self._acquire_script = self._redis.register_script(ACQUIRE_SCRIPT)
+        self._heartbeat_script = self._redis.register_script(HEARTBEAT_SCRIPT)
+        self._reconcile_script = self._redis.register_script(RECONCILE_SCRIPT)
+
+    async def _acquire(self, key, max_connections, lease):
+        count = await self._acquire_script(keys=[key], args=[max_connections, self.lease_ttl, lease])
+        return None if count < 0 else count
+
+    async def _release(self, key, lease):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.zrem(key, lease)
+            pipe.zcard(key)
+            _, count = await pipe.execute()
+        return count
+
+    async def heartbeat(self, leases):
+        for start in range(0, len(leases), HEARTBEAT_BATCH_SIZE):
+            batch = leases[start:start + HEARTBEAT_BATCH_SIZE]
+            await self._heartbeat_script(
+                keys=[key for _, key in batch],
+                args=[self.lease_ttl, *(lease for lease, _ in batch)],
+            )
+
+    async def reconcile(self, reset=False):
+        """
+        Drop expired leases (or every lease when reset is True) across all
+        tokens. Returns {key: live lease count}.
+        """
+        counts = {}
+        async for key in self._redis.scan_iter(match=f"{KEY_PREFIX}*", count=1000):
+            key = key.decode() if isinstance(key, bytes) else key
+            if reset:
+                await self._redis.delete(key)
+                continue
+            counts[key] = await self._reconcile_script(keys=[key])
+        return counts
+
+
+class LocalConnectionCounter(BaseConnectionCounter):
+    """
+    In-process counterpart of RedisConnectionCounter for single-worker setups.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._sets = {}  # lease set key -> {lease id: expiry}
+
+    def _live(self, key):
+        now = time.time()
+        members = self._sets.get(key, {})
+        for lease, expiry in list(members.items()):
+            if expiry <= now:
+                del members[lease]
+        return members
+
+    async def _acquire(self, key, max_connections, lease):
+        members = self._live(key)
+        if 0 < max_connections <= len(members):
+            return None
+        members[lease] = time.time() + self.lease_ttl
+        self._sets[key] = members
+        return len(members)
+
+    async def _release(self, key, lease):
+        members = self._live(key)
+        members.pop(lease, None)
+        if not members:
+            self._sets.pop(key, None)
+        return len(members)
+
+    async def heartbeat(self, leases):
+        expiry = time.time() + self.lease_ttl
+        for lease, key in leases:
+            members = self._sets.get(key)
+            if members is not None and lease in members:
+                members[lease] = expiry
+
+    async def reconcile(self, reset=False):
+        if reset:
+            self._sets.clear()
+        for key in list(self._sets):
+            if not self._live(key):
+                del self._sets[key]
+        return {key: len(members) for key, members in self._sets.items()}
+
+
+_counter = None
+
+
+def get_connection_counter():
+    global _counter
+    if _counter is None:
+        url = get_setting('REDIS_URL')
+        if url:
+            _counter = RedisConnectionCounter(url, get_setting('REDIS_MAX_CONNECTIONS'))
+        else:
+            logger.warning("BROCKER_REDIS_URL is not set; counting connections in-process.")
+            _counter = LocalConnectionCounter()
+    return _counter
@@ -1,20 +1,115 @@
+import asyncio
+import hashlib
+import itertools
+from functools import lru_cache
 from channels.generic.websocket import AsyncWebsocketConsumer
-import json
-from brocker.MqttPatternMatcher import MqttPatternMatcher
+from brocker.codecs import (
+    MSGPACK_SUBPROTOCOL, InvalidFrame, frame_for, get_binary_codec, get_codec,
+)
+from brocker.check_tags_permissions import get_token_permissions
 import re
 import logging
-from django.core.cache import cache
+from brocker.conf import get_setting
+from brocker.connection_counter import get_connection_counter
+from brocker.fanout import FANOUT_TYPE, fanout
+from brocker.outbound import OutboundQueue, is_batched_tag, is_batched_token
+from brocker.replay import get_replay_buffer, is_replayed_tag
+from brocker.retained import get_retained_store
+from brocker.routes import get_route_registry
+from brocker.topic_tree import TopicTree, level_prefixes, literal_prefix
 
 logger = logging.getLogger(__name__)
 
+# Distinct tags, prefixes and tokens whose group names are kept in memory.
+GROUP_NAME_CACHE_SIZE = 65536
+# Characters of the sanitized value kept in a group name for readability.
+GROUP_NAME_READABLE_LENGTH = 60
+
+# Numbers the publishes of this process; see LocalFanout.dispatch.
+_publish_ids = itertools.count()
+
 def sanitize_tag(tag):
     tag = str(tag)
     tag = re.sub(r'[^0-9a-zA-Z\-\._]', '_', tag)
     return tag[:100]
 
+@lru_cache(maxsize=GROUP_NAME_CACHE_SIZE)
+def group_name(kind, value):
+    """
+    Channel-layer group name for a value of the given kind ('tag', 'route'
+    or 'token').
+
+    The sanitized value is only kept as a readable hint; the digest of the
+    raw value keeps distinct values in distinct groups, whatever characters
+    they contain or however long they are.
+    """
+    digest = hashlib.blake2b(str(value).encode(), digest_size=10).hexdigest()
+    return f"{kind}.{sanitize_tag(value)[:GROUP_NAME_READABLE_LENGTH]}.{digest}"
+
+def tag_group(tag):
+    return group_name("tag", tag)
+
+def route_group(prefix):
+    """
+    Group joined by workers with wildcard subscriptions under prefix.
+    """
+    return group_name("route", prefix)
+
+def token_group(token):
+    """
+    Group of every connection authenticated with token, for control messages.
+    """
+    return group_name("token", token)
+
+def subscription_group(tag):
+    """
+    Group that carries the messages of a subscribed tag or pattern.
+    """
+    prefix = literal_prefix(tag)
+    return tag_group(tag) if prefix == tag else route_group(prefix)
+
+@lru_cache(maxsize=GROUP_NAME_CACHE_SIZE)
+def publish_routes(tag):
+    """
+    The route group of each leading level prefix of a published tag, where
+    its wildcard subscribers may be.
+    """
+    return tuple(route_group(prefix) for prefix in level_prefixes(tag))
+
+def publish_groups(tag, routes):
+    """
+    Every group that may hold subscribers of a published tag: the exact
+    tag group and the route groups that routes, a route registry, knows
+    wildcard subscribers joined.
+    """
+    return [tag_group(tag), *(group for group in publish_routes(tag) if routes.is_active(group))]
+
 class BrokerConsumer(AsyncWebsocketConsumer):
+    # True when the client negotiated MessagePack frames.
+    binary_frames = False
+    # Frames waiting to be written to the client; set up on connect.
+    outbound = None
+    # True when every message to this client is batched (BROCKER_BATCH_TOKENS).
+    batch_all = False
+    # Subscribed tags by the id of the BrokerTags row granting them, so
+    # control events about other tags are skipped without matching.
+    granted_tags = {}
+    # Subscribed tags, to find those a granted pattern matches.
+    subscriptions = TopicTree()
+    # Live events held back while retained and missed messages are queued
+    # on connect, and the task queueing them; see catch_up().
+    held_events = None
+    catch_up_task = None
+
     async def connect(self):
-        await self.accept()
+        if MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", []):
+            self.binary_frames = True
+            await self.accept(subprotocol=MSGPACK_SUBPROTOCOL)
+        else:
+            await self.accept()
+        codec = get_binary_codec() if self.binary_frames else get_codec()
+        self.batch_all = is_batched_token(self.scope.get("token_name"))
+        self.outbound = OutboundQueue(self.send, self.close, join_frames=codec.join_frames)
         logger.info(
             "Client connected: path=%s, user=%s",
             self.scope.get("path"),
@@ -24,31 +119,33 @@ class BrokerConsumer(AsyncWebsocketConsumer):
         max_connections = self.scope.get("max_connections", 0)
 
         if token and max_connections > 0:
-            safe_token = sanitize_tag(token)
-            cache_key = f"connections:{safe_token}"
-            connection_count = cache.incr(cache_key, 1)
+            # The slot itself was taken by AuthMiddlewareBroker.
             logger.info(
                 "Client connected: token=%s, connections=%s/%s, channel=%s",
-                token, connection_count, max_connections, self.channel_name
+                token, self.scope.get("connection_count"), max_connections, self.channel_name
             )
         else:
             logger.info("Client connected: token=%s, channel=%s", token, self.channel_name)
 
-        for tag in self.scope.get("tag_permissions", {}).keys():
-            safe_tag = sanitize_tag(tag)
-            await self.channel_layer.group_add(safe_tag, self.channel_name)
-        
-        if token:
-            await self.channel_layer.group_add(f"token_{sanitize_tag(token)}", self.channel_name)
+        self.index_grants()
+        self.held_events = []
+        await self.join_groups()
+        # Not awaited, so that a disconnect or an access change is handled
+        # while the client catches up.
+        self.catch_up_task = asyncio.get_running_loop().create_task(self.catch_up())
 
     async def disconnect(self, close_code):
         token = self.scope.get("token")
+        if self.catch_up_task is not None:
+            self.catch_up_task.cancel()
+        if self.outbound is not None:
+            self.outbound.close()
+            if self.outbound.dropped:
+                logger.info("Dropped %d outbound frames for token %s", self.outbound.dropped, token)
         max_connections = self.scope.get("max_connections", 0)
 
         if token and max_connections > 0:
-            safe_token = sanitize_tag(token)
-            cache_key = f"connections:{safe_token}"
-            connection_count = cache.decr(cache_key, 1)
+            connection_count = await get_connection_counter().release(token, self.scope.get("connection_lease"))
             logger.info(
                 "Client disconnected: token=%s, connections=%s/%s, channel=%s, code=%s",
                 token, connection_count, max_connections, self.channel_name, close_code
@@ -59,89 +156,339 @@ class BrokerConsumer(AsyncWebsocketConsumer):
                 token, self.channel_name, close_code
             )
 
+        await self.leave_groups()
+
+    async def join_groups(self):
+        """
+        Subscribe to every tag of the connection and join its token group.
+        """
+        # Each join may be a channel-layer round trip; issue them all at
+        # once instead of one after another. Tag groups are joined once per
+        # worker; see brocker.fanout.
+        token = self.scope.get("token")
+        joins = [
+            fanout.subscribe(subscription_group(tag), tag, self, route=literal_prefix(tag) != tag)
+            for tag in self.scope.get("tag_permissions", {})
+        ]
         if token:
-            await self.channel_layer.group_discard(f"token_{sanitize_tag(token)}", self.channel_name)
-        
-        for tag in self.scope.get("tag_permissions", {}):
-            safe_tag = sanitize_tag(tag)
-            await self.channel_layer.group_discard(safe_tag, self.channel_name)
+            joins.append(self.channel_layer.group_add(token_group(token), self.channel_name))
+        await asyncio.gather(*joins)
+
+    async def catch_up(self):
+        """
+        Queue the retained message of every subscribed tag, and of every tag
+        matched by a subscribed pattern, then the messages missed since the
+        Last-Id the client sent, and only then the live messages received
+        meanwhile.
+        """
+        token = self.scope.get("token")
+        # Only the subscriptions a grant covers (see check_tags_permissions),
+        # so the tags their patterns match are all granted too.
+        subscriptions = list(self.scope.get("tag_permissions", {}))
+        last_id = self.scope.get("last_id")
+        try:
+            retained = await get_retained_store().matching(subscriptions)
+        except Exception:
+            logger.exception("Failed to fetch retained messages for token %s", token)
+            retained = {}
+        # A live message is newer than the retained one of its tag. With
+        # Last-Id, a retained message the client has not seen is usually
+        # replayed; it is only sent once replay shows it is not.
+        live_tags = {event.get('tag') for event in self.held_events}
+        unseen = {}
+        for tag, entry in retained.items():
+            if tag in live_tags:
+                continue
+            if last_id is None or entry.get('id') is None:
+                self.queue_frames({"tag": tag, **entry})
+            elif entry['id'] > last_id:
+                unseen[tag] = entry
+
+        replayed = {}  # tag -> id of its last replayed message
+        if last_id is not None:
+            buffer = get_replay_buffer()
+            count = 0
+            try:
+                async for tag, entries in buffer.replay(subscriptions, last_id):
+                    for message_id, message in entries:
+                        await self.queue_in_turn({"tag": tag, "message": message, "id": message_id})
+                    replayed[tag] = entries[-1][0]
+                    count += len(entries)
+                    if self.outbound.closed:
+                        return
+            except Exception:
+                logger.exception("Failed to replay missed messages for token %s", token)
+            if replayed:
+                logger.info("Replayed %d messages on %d tags for token %s", count, len(replayed), token)
+
+            # Retained messages that were trimmed or expired from their
+            # buffer. Past the replay limit the client resumes from the last
+            # replayed id, so none is sent ahead of the rest.
+            if count < buffer.max_messages:
+                live_tags = {event.get('tag') for event in self.held_events}
+                for tag, entry in unseen.items():
+                    if tag not in live_tags and replayed.get(tag, last_id) < entry['id']:
+                        self.queue_frames({"tag": tag, **entry})
+
+        # Live events keep being held while earlier ones wait for room.
+        while self.held_events:
+            held_events, self.held_events = self.held_events, []
+            for event in held_events:
+                await self.queue_in_turn(event, after=replayed.get(event.get('tag')))
+        self.held_events = None
+
+    async def queue_in_turn(self, event, after=None):
+        """
+        Queue an event once the client has room for it, so that catching up
+        never overflows the outbound queue. Under the conflate policy, the
+        pending frames of one tag still replace each other.
+        """
+        if len(self.outbound) >= self.outbound.maxsize:
+            await self.outbound.join()
+        self.queue_frames(event, after)
+
+    async def leave_groups(self):
+        token = self.scope.get("token")
+        leaves = [
+            fanout.unsubscribe(subscription_group(tag), tag, self)
+            for tag in self.scope.get("tag_permissions", {})
+        ]
+        if token:
+            leaves.append(self.channel_layer.group_discard(token_group(token), self.channel_name))
+        await asyncio.gather(*leaves)
 
     async def receive(self, text_data=None, bytes_data=None):
         token = self.scope.get("token")
-        if not text_data:
+        # Text frames are always JSON, binary frames always MessagePack.
+        if text_data:
+            data, codec = text_data, get_codec()
+        elif bytes_data:
+            data, codec = bytes_data, get_binary_codec()
+        else:
             return
 
         try:
-            data = json.loads(text_data)
-        except json.JSONDecodeError:
-            logger.warning("Invalid JSON received from token %s: %s", token, text_data)
+            envelopes = codec.decode_envelopes(data, get_setting('PUBLISH_BATCH_MAX_ENVELOPES'))
+        except InvalidFrame as exc:
+            logger.warning("Invalid frame received from token %s (%s): %r", token, exc, data)
             return
 
-        tag = data.get('tag')
-        message = data.get('message')
-
-        if not tag or not message:
-            logger.debug("Received incomplete message from token %s: %s", token, text_data)
-            return
+        # A frame may carry a batch of envelopes; check each distinct tag once
+        # and publish all of its messages with a single group_send.
+        messages_by_tag = {}
+        retained = {}  # tag -> index of its last message to retain
+        for tag, message, retain in envelopes:
+            messages = messages_by_tag.setdefault(tag, [])
+            if retain:
+                retained[tag] = len(messages)
+            messages.append(message)
 
         permissions = self.scope.get('tag_permissions', {})
-        if tag in permissions and permissions[tag] == 'readwrite':
-            logger.debug("Broadcasting message from token %s to tag '%s'", token, tag)
-            safe_tag = sanitize_tag(tag)
-            await self.channel_layer.group_send(
-                safe_tag,
-                {
-                    "type": "broadcast_message",
-                    "tag": tag,
-                    "message": message,
-                    "channel": self.channel_name,
-                }
-            )
+        sends = []
+        for tag, messages in messages_by_tag.items():
+            if permissions.get(tag) == 'readwrite':
+                logger.debug("Broadcasting %d message(s) from token %s to tag '%s'", len(messages), token, tag)
+                sends.append(self.publish(tag, messages, retained.get(tag)))
+            else:
+                logger.warning(
+                    "Write attempt denied for token %s on tag '%s' (permission: %s)",
+                    token, tag, permissions.get(tag, 'None')
+                )
+
+        # Issue the group sends of different tags concurrently so they are
+        # pipelined to the channel layer instead of awaited one by one; only
+        # the messages of one tag, sent together, keep their frame order.
+        if len(sends) == 1:
+            await sends[0]
+        elif sends:
+            await asyncio.gather(*sends)
+
+    async def publish(self, tag, messages, retain=None):
+        """
+        Send messages published on tag to its subscribers, including those
+        subscribed with a matching wildcard pattern. The message at index
+        retain, if any, becomes the retained message of the tag. Messages on
+        replayed tags are buffered first, to number them.
+        """
+        # Frames are encoded by the receiving workers, once per message and
+        # only in the formats their subscribers use; see frame_for.
+        routes = get_route_registry()
+        await routes.start()
+        groups = publish_groups(tag, routes)
+        event = {
+            "type": FANOUT_TYPE,
+            "tag": tag,
+            "channel": self.channel_name,
+        }
+        if len(groups) > 1:
+            event["publish_id"] = f"{self.channel_name}:{next(_publish_ids)}"
+        ids = [None] * len(messages)
+        if is_replayed_tag(tag):
+            try:
+                ids = await get_replay_buffer().append(tag, messages)
+            except Exception:
+                logger.exception("Failed to buffer %d message(s) on tag '%s' for replay", len(messages), tag)
+        entries = [
+            {"message": message} if message_id is None else {"message": message, "id": message_id}
+            for message, message_id in zip(messages, ids)
+        ]
+        if len(entries) == 1:
+            event.update(entries[0])
         else:
-            logger.warning(
-                "Write attempt denied for token %s on tag '%s' (permission: %s)",
-                token, tag, permissions.get(tag, 'None')
-            )
+            event["frames"] = entries
+        sends = [self.channel_layer.group_send(group, event) for group in groups]
+        if retain is not None:
+            sends.append(self.retain(tag, entries[retain]))
+        await asyncio.gather(*sends)
+
+    async def retain(self, tag, entry):
+        try:
+            await get_retained_store().set(tag, entry)
+        except Exception:
+            logger.exception("Failed to retain message on tag '%s'", tag)
+
+    def deliver(self, event):
+        """
+        Queue the frames of a published message for this client.
+        """
+        if self.held_events is not None:
+            if len(self.held_events) >= self.outbound.maxsize:
+                # Too far behind to catch up; the client can resume from
+                # the last id it got after reconnecting.
+                logger.warning("Closing slow consumer: %d live events held while catching up", len(self.held_events))
+                self.outbound.disconnect(dropped=len(self.held_events) + 1)
+                self.held_events.clear()
+            elif not self.outbound.closed:
+                self.held_events.append(event)
+            return
+        self.queue_frames(event)
+
+    def queue_frames(self, event, after=None):
+        """
+        Queue the frames of one event, skipping those with an id up to after.
+        """
+        if self.outbound is None:
+            return
+        tag = event.get('tag')
+        key = 'bytes' if self.binary_frames else 'text'
+        batch = self.batch_all or is_batched_tag(tag)
+        for entry in event.get('frames') or (event,):
+            if after is not None and entry.get('id') is not None and entry['id'] <= after:
+                continue
+            frame = frame_for(entry, tag, key)
+            if frame is None:
+                logger.debug("Message on tag '%s' cannot be sent in this client's frame format", tag)
+            else:
+                self.outbound.put(tag, frame, batch=batch)
 
     async def broadcast_message(self, event):
+        # Sent straight to this channel by publishers that predate the
+        # per-worker fan-out.
         if event.get('channel') == self.channel_name:
             return
-            
-        await self.send(text_data=json.dumps({
-            "tag": event['tag'],
-            "message": event['message'],
-        }))
+        self.deliver(event)
+
+    async def access_changes(self, event):
+        """
+        Apply every access change of one committed transaction, sent as a
+        single message per token by brocker.notifications.
+        """
+        return await self.apply_changes(event.get("changes", ()), event.get("revision"))
+
+    # Single changes sent on their own by senders that predate access_changes.
 
     async def permission_update(self, event):
-        token = self.scope.get("token")
-        pattern = event.get('pattern')
-        permission = event.get('permission')
-        matcher = MqttPatternMatcher()
-        
-        for tag in self.scope.get('tag_permissions', {}).keys():
-            if matcher.is_match(tag, [pattern])['match'] and permission not in ["read", "readwrite"]:
-                logger.warning(
-                    "Closing connection for token %s due to revoked permission on pattern '%s'",
-                    token, pattern
-                )
-                await self.close(code=4001)
-                return
+        return await self.apply_changes([event])
 
     async def token_update(self, event):
-        token = self.scope.get("token")
-        logger.warning("Closing connection for token %s due to token modification or deletion.", token)
-        await self.close(code=4002)
-    
+        return await self.apply_changes([event])
+
     async def tag_update(self, event):
+        return await self.apply_changes([event])
+
+    def index_grants(self):
+        self.granted_tags = {}
+        for tag, tag_id in self.scope.get("tag_ids", {}).items():
+            self.granted_tags.setdefault(tag_id, []).append(tag)
+        self.subscriptions = TopicTree((tag, None) for tag in self.scope.get("tag_permissions", {}))
+
+    def is_affected(self, change):
+        """
+        Whether a permission or tag change may alter what this connection is
+        granted: it is about the tag granting one of its subscriptions, or it
+        grants a pattern matching one of them.
+        """
+        tag_id = change.get('tag_id')
+        if tag_id is not None and tag_id in self.granted_tags:
+            return True
+
+        patterns = []
+        if change.get('type') == 'permission_update':
+            # Changes without a tag id are matched by their pattern alone.
+            if change.get('permission') or tag_id is None:
+                patterns.append(change.get('pattern'))
+        elif change.get('type') == 'tag_update':
+            patterns.append(change.get('prefix'))
+            if tag_id is None:
+                patterns.append(change.get('old_prefix'))
+
+        return any(self.subscriptions.matched_by(pattern) for pattern in filter(None, patterns))
+
+    async def apply_changes(self, changes, revision=None):
+        """
+        Re-check the subscriptions of this connection after access changes,
+        updating their permissions in place. Returns True when the
+        connection was closed.
+        """
+        if any(change.get("type") == "token_update" for change in changes):
+            return await self.close_for_token_change()
+        if not any(self.is_affected(change) for change in changes):
+            return False
+
         token = self.scope.get("token")
-        old_prefix = event.get('old_prefix')
-        matcher = MqttPatternMatcher()
+        # Every socket of the token on this worker shares one reload per revision.
+        token_permissions = await get_token_permissions(token, refresh=True, revision=revision)
+        if token_permissions is None:
+            return await self.close_for_token_change()
 
-        for tag in self.scope.get("tag_permissions", {}).keys():
-            if matcher.is_match(tag, [old_prefix])['match']:
-                logger.warning(
-                    "Closing connection for token %s due to modification of subscribed tag pattern '%s'",
-                    token, old_prefix
+        tag_permissions = {}
+        tag_ids = {}
+        lost = []
+        for tag in self.scope.get('tag_permissions', {}):
+            found = token_permissions.index.match_pattern(tag)
+            if found is None:
+                lost.append(tag)
+            else:
+                tag_permissions[tag], tag_ids[tag] = found[1]
+
+        if lost:
+            old_tag_ids = self.scope.get('tag_ids', {})
+            lost_tag_ids = {old_tag_ids.get(tag) for tag in lost}
+            tag_changed = any(
+                change.get('type') == 'tag_update' and change.get('tag_id') in lost_tag_ids
+                for change in changes
+            )
+            logger.warning(
+                "Closing connection for token %s: no permission left on subscribed tags %s",
+                token, lost
+            )
+            await self.close(code=4003 if tag_changed else 4001)
+            return True
+
+        old_permissions = self.scope.get('tag_permissions', {})
+        for tag, permission in tag_permissions.items():
+            if old_permissions.get(tag) != permission:
+                logger.info(
+                    "Permission of token %s on tag '%s' changed from %s to %s",
+                    token, tag, old_permissions.get(tag), permission
                 )
-                await self.close(code=4003)
-                return
\ No newline at end of file
+        self.scope['tag_permissions'] = tag_permissions
+        self.scope['tag_ids'] = tag_ids
+        self.index_grants()
+        return False
+
+    async def close_for_token_change(self):
+        token = self.scope.get("token")
+        logger.warning("Closing connection for token %s due to token modification or deletion.", token)
+        await self.close(code=4002)
+        return True
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from brocker.routes import get_route_registry
+from brocker.topic_tree import TopicTree
+from brocker.worker_channel import worker_channel
+
+logger = logging.getLogger(__name__)
+
+FANOUT_TYPE = "fanout.message"
+# Publishes remembered per worker to hand out only the first of their copies.
+SEEN_PUBLISHES_SIZE = 10000
+
+
+class LocalFanout:
+    """
+    Keeps tag group membership inside the worker process.
+
+    Only the worker channel joins channel-layer groups, once per group that
+    has at least one local subscriber, so the channel layer delivers each
+    published message once per worker instead of once per socket. The worker
+    then matches the published tag against the subscription patterns of its
+    sockets and hands the message to every matching subscriber once.
+    """
+
+    def __init__(self):
+        self._members = {}  # group -> set of (pattern, consumer)
+        self._subscriptions = TopicTree()  # pattern -> set of consumers
+        self._patterns = {}  # the same sets, looked up by pattern
+        self._joined = set()
+        self._routes = set()  # groups subscribed to as route groups
+        self._locks = {}  # group -> [lock, number of coroutines using it]
+        self._seen = OrderedDict()  # publish ids of recent multi-group publishes
+
+    def subscribers(self, tag):
+        """
+        Returns the local consumers subscribed to a pattern matching tag.
+        """
+        found = set()
+        for _, consumers in self._subscriptions.match_all(tag):
+            found.update(consumers)
+        return found
+
+    async def _sync_membership(self, group):
+        # Serialize joins and leaves of one group, so a leave by the last
+        # subscriber cannot overtake a join by the next one.
+        entry = self._locks.setdefault(group, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                wanted = bool(self._members.get(group))
+                if wanted and group not in self._joined:
+                    await worker_channel.group_add(group)
+                    self._joined.add(group)
+                    if group in self._routes:
+                        await get_route_registry().add(group)
+                elif not wanted and group in self._joined:
+                    if group in self._routes:
+                        self._routes.discard(group)
+                        await get_route_registry().discard(group)
+                    await worker_channel.group_discard(group)
+                    self._joined.discard(group)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[group]
+
+    async def subscribe(self, group, pattern, consumer, route=False):
+        """
+        Subscribe consumer to pattern, whose messages are sent to group.
+        Route groups (route=True) are registered with the route registry
+        once joined, so that publishers send to them.
+        """
+        if route:
+            self._routes.add(group)
+        consumers = self._patterns.get(pattern)
+        if consumers is None:
+            consumers = self._patterns[pattern] = set()
+            self._subscriptions.insert(pattern, consumers)
+        consumers.add(consumer)
+        self._members.setdefault(group, set()).add((pattern, consumer))
+        # Also wait for a leave in flight, which would otherwise remove the
+        # worker from a group this subscriber needs.
+        if group not in self._joined or group in self._locks:
+            await self._sync_membership(group)
+
+    async def unsubscribe(self, group, pattern, consumer):
+        members = self._members.get(group)
+        if members is None or (pattern, consumer) not in members:
+            return
+        members.discard((pattern, consumer))
+        consumers = self._patterns[pattern]
+        consumers.discard(consumer)
+        if not consumers:
+            del self._patterns[pattern]
+            self._subscriptions.remove(pattern)
+        if not members:
+            del self._members[group]
+            await self._sync_membership(group)
+
+    async def dispatch(self, event):
+        """
+        Deliver a message received by the worker channel to local subscribers.
+        """
+        # A message is sent to every group that may hold subscribers of its
+        # tag; a worker in several of them hands out the first copy to
+        # arrive and skips the others, whichever groups it has joined yet.
+        publish_id = event.get("publish_id")
+        if publish_id is not None:
+            if publish_id in self._seen:
+                return
+            self._seen[publish_id] = None
+            if len(self._seen) > SEEN_PUBLISHES_SIZE:
+                self._seen.popitem(last=False)
+        elif event.get("groups"):
+            # Sent by a publisher that predates publish ids.
+            first = next((group for group in event["groups"] if group in self._joined), None)
+            if first != event.get("group"):
+                return
+
+        sender = event.get("channel")
+        for consumer in self.subscribers(event["tag"]):
+            if consumer.channel_name != sender:
+                consumer.deliver(event)
+
+
+fanout = LocalFanout()
+worker_channel.register(FANOUT_TYPE, fanout.dispatch)
@@ -0,0 +1,323 @@
+import asyncio
+import json
+import random
+import time
+
+from channels.layers import InMemoryChannelLayer, channel_layers
+from django.core.management.base import BaseCommand
+
+from brocker.MqttPatternMatcher import MqttPatternMatcher
+from brocker.codecs import CODECS
+from brocker.consumers import BrokerConsumer, tag_group, token_group
+from brocker.fanout import FANOUT_TYPE, LocalFanout
+from brocker.outbound import OutboundQueue
+from brocker.replay import get_replay_buffer
+from brocker.topic_tree import TopicTree
+
+
+def _timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+async def _timed_async(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await func()
+    return (time.perf_counter() - start) / repeat
+
+
+def _permission_patterns(count):
+    patterns = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            patterns.append(f"site{i}/+/temperature")
+        elif kind == 1:
+            patterns.append(f"fleet{i}/#")
+        else:
+            patterns.append(f"devices/dev{i}/status")
+    return patterns
+
+
+def bench_permissions(command, options):
+    """
+    Resolve the tags of one connection against a token holding N patterns,
+    comparing a linear scan of compiled patterns with the TopicTree index.
+    """
+    matcher = MqttPatternMatcher()
+    rng = random.Random(0)
+
+    for count in options['sizes']:
+        patterns = _permission_patterns(count)
+        permissions = [(pattern, 'read') for pattern in patterns]
+        index = TopicTree(permissions)
+        tags = [
+            rng.choice(patterns).replace('+', 'room1').replace('#', 'a/b')
+            for _ in range(options['tags'])
+        ]
+
+        linear = _timed(lambda: matcher.match_many(tags, patterns), options['repeat'])
+        indexed = _timed(lambda: [index.match(tag) for tag in tags], options['repeat'])
+
+        command.stdout.write(
+            f"patterns={count:<6} linear={linear * 1e6:10.1f}us  "
+            f"trie={indexed * 1e6:8.1f}us  speedup={linear / indexed:6.1f}x"
+        )
+
+
+class _NullOutbound:
+    def put(self, tag, frame, batch=False):
+        pass
+
+
+def _subscribers(count):
+    consumers = []
+    for i in range(count):
+        consumer = BrokerConsumer()
+        consumer.channel_name = f"bench.{i}"
+        consumer.outbound = _NullOutbound()
+        consumers.append(consumer)
+    return consumers
+
+
+def bench_fanout(command, options):
+    """
+    CPU cost of delivering one published message to N subscribers, encoding
+    the frame per recipient vs. forwarding the frame encoded by the publisher,
+    and handing it out from one per-worker fan-out event.
+    """
+    message = {"value": 21.5, "unit": "C", "ts": 1700000000, "labels": ["a", "b", "c"]}
+    repeat = max(1, options['repeat'] // 20)
+
+    for count in options['sizes']:
+        consumers = _subscribers(count)
+
+        async def per_recipient():
+            # Every consumer gets its own copy of the event, as from its own
+            # channel, and encodes the message itself.
+            for consumer in consumers:
+                event = {"type": "broadcast_message", "tag": "sensors/a", "message": message, "channel": "pub"}
+                await consumer.broadcast_message(event)
+
+        async def encoded_once():
+            event = {"type": "broadcast_message", "tag": "sensors/a", "message": message, "channel": "pub"}
+            for consumer in consumers:
+                await consumer.broadcast_message(event)
+
+        local = LocalFanout()
+        # Subscribed without joining any channel-layer group.
+        local._patterns["sensors/a"] = set(consumers)
+        local._subscriptions.insert("sensors/a", local._patterns["sensors/a"])
+
+        async def worker_fanout():
+            await local.dispatch({
+                "type": FANOUT_TYPE, "group": "sensors.a", "tag": "sensors/a",
+                "message": message, "channel": "pub",
+            })
+
+        before = asyncio.run(_timed_async(per_recipient, repeat))
+        after = asyncio.run(_timed_async(encoded_once, repeat))
+        fanned = asyncio.run(_timed_async(worker_fanout, repeat))
+        command.stdout.write(
+            f"subscribers={count:<7} per-recipient={before * 1e3:8.2f}ms  "
+            f"encoded-once={after * 1e3:8.2f}ms  worker-fanout={fanned * 1e3:8.2f}ms  "
+            f"speedup={before / fanned:5.1f}x"
+        )
+
+
+def bench_routing(command, options):
+    """
+    Find the subscriptions matching a published tag among N subscribed
+    patterns, scanning every compiled pattern vs. the TopicTree index.
+    """
+    compile_pattern = MqttPatternMatcher.compile
+    rng = random.Random(0)
+
+    for count in options['sizes']:
+        patterns = _permission_patterns(count)
+        index = TopicTree((pattern, None) for pattern in patterns)
+        topics = [
+            rng.choice(patterns).replace('+', 'room1').replace('#', 'a/b')
+            for _ in range(options['tags'])
+        ]
+
+        compiled = [(pattern, compile_pattern(pattern)) for pattern in patterns]
+
+        def linear():
+            for topic in topics:
+                [pattern for pattern, regex in compiled if regex.match(topic)]
+
+        def indexed():
+            for topic in topics:
+                index.match_all(topic)
+
+        scan = _timed(linear, options['repeat']) / len(topics)
+        trie = _timed(indexed, options['repeat']) / len(topics)
+        command.stdout.write(
+            f"subscriptions={count:<7} linear={scan * 1e6:10.1f}us  "
+            f"trie={trie * 1e6:8.1f}us  speedup={scan / trie:8.1f}x"
+        )
+
+
+class _DelayedChannelLayer(InMemoryChannelLayer):
+    """
+    In-memory layer whose membership calls take one simulated round trip.
+    """
+
+    def __init__(self, rtt, **kwargs):
+        super().__init__(**kwargs)
+        self.rtt = rtt
+
+    async def group_add(self, group, channel):
+        await asyncio.sleep(self.rtt)
+        await super().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await asyncio.sleep(self.rtt)
+        await super().group_discard(group, channel)
+
+
+def bench_connect(command, options):
+    """
+    Time to set up the group membership of one connection with N tags over
+    a channel layer with --rtt ms per call, joining groups one by one vs.
+    BrokerConsumer.join_groups.
+    """
+    layer = _DelayedChannelLayer(options['rtt'] / 1000)
+    channel_layers.backends['default'] = layer
+    repeat = max(1, options['repeat'] // 20)
+
+    for count in options['sizes']:
+        async def one_by_one():
+            tags = [f"bench/{random.random()}" for _ in range(count)]
+            for tag in tags:
+                await layer.group_add(tag_group(tag), "bench.1")
+            await layer.group_add(token_group("bench"), "bench.1")
+
+        async def concurrent():
+            consumer = BrokerConsumer()
+            consumer.channel_layer = layer
+            consumer.channel_name = "bench.1"
+            # Fresh tags, so every subscription is also a new group for the worker.
+            consumer.scope = {
+                "token": "bench",
+                "tag_permissions": {f"bench/{random.random()}": "read" for _ in range(count)},
+            }
+            start = time.perf_counter()
+            await consumer.join_groups()
+            elapsed = time.perf_counter() - start
+            await consumer.leave_groups()
+            return elapsed
+
+        async def run_concurrent():
+            total = 0
+            for _ in range(repeat):
+                total += await concurrent()
+            return total / repeat
+
+        before = asyncio.run(_timed_async(one_by_one, repeat))
+        after = asyncio.run(run_concurrent())
+        command.stdout.write(
+            f"tags={count:<6} one-by-one={before * 1e3:8.2f}ms  "
+            f"concurrent={after * 1e3:8.2f}ms  speedup={before / after:6.1f}x"
+        )
+
+
+def bench_replay(command, options):
+    """
+    Throughput of a reconnecting client catching up on N missed messages
+    from the replay buffer (Redis when BROCKER_REDIS_URL is set), reading
+    one message per step vs. batches of BROCKER_REPLAY_BATCH_SIZE.
+    """
+    buffer = get_replay_buffer()
+    batch_size = buffer.batch_size
+    message = {"value": 21.5, "unit": "C", "ts": 1700000000}
+
+    async def sent(text_data=None, bytes_data=None):
+        pass
+
+    async def catch_up(tag, last_id, size):
+        buffer.batch_size = size
+        consumer = BrokerConsumer()
+        # Through a pattern, which replays tags outside BROCKER_REPLAY_TAGS.
+        consumer.scope = {"tag_permissions": {f"{tag}/#": "read"}, "last_id": last_id}
+        consumer.outbound = OutboundQueue(sent, None)
+        consumer.held_events = []
+        start = time.perf_counter()
+        await consumer.catch_up()
+        await consumer.outbound.join()
+        elapsed = time.perf_counter() - start
+        consumer.outbound.close()
+        return elapsed
+
+    async def run(count):
+        tag = f"bench/replay/{random.random()}"
+        buffer.maxlen = buffer.max_messages = max(count, buffer.maxlen)
+        ids = await buffer.append(tag, [message] * count)
+        return await catch_up(tag, ids[0] - 1, 1), await catch_up(tag, ids[0] - 1, batch_size)
+
+    for count in options['sizes']:
+        single, batched = asyncio.run(run(count))
+        command.stdout.write(
+            f"missed={count:<7} one-by-one={count / single:10.0f} msg/s  "
+            f"batched({batch_size})={count / batched:10.0f} msg/s  speedup={single / batched:5.1f}x"
+        )
+
+
+def bench_codec(command, options):
+    """
+    Decode an inbound envelope and encode the outbound frame with each
+    available JSON codec.
+    """
+    frame = json.dumps({"tag": "sensors/room1/temp", "message": {"value": 21.5, "unit": "C", "ts": 1700000000}})
+    repeat = options['repeat'] * 50
+
+    for name, codec_class in CODECS.items():
+        try:
+            codec = codec_class()
+        except ImportError:
+            command.stdout.write(f"codec={name:<8} not installed")
+            continue
+
+        def roundtrip():
+            for tag, message, _ in codec.decode_envelopes(frame, 1):
+                codec.encode_frame(tag, message)
+
+        command.stdout.write(f"codec={name:<8} {_timed(roundtrip, repeat) * 1e6:6.2f}us per message")
+
+
+# --sizes of the scenarios that measure something else than 10/100/1000.
+DEFAULT_SIZES = {
+    'fanout': [1000, 10000],
+}
+
+SCENARIOS = {
+    'codec': bench_codec,
+    'connect': bench_connect,
+    'fanout': bench_fanout,
+    'permissions': bench_permissions,
+    'replay': bench_replay,
+    'routing': bench_routing,
+}
+
+
+class Command(BaseCommand):
+    help = "Run micro-benchmarks for the broker hot paths."
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument(
+            '--sizes', type=int, nargs='+',
+            help="Sizes to measure. Defaults to 10 100 1000 (1000 10000 for fanout).",
+        )
+        parser.add_argument('--tags', type=int, default=10, help="Tags requested per connection.")
+        parser.add_argument('--repeat', type=int, default=200)
+        parser.add_argument('--rtt', type=float, default=1.0, help="Simulated channel layer round trip in ms.")
+
+    def handle(self, *args, **options):
+        if options['sizes'] is None:
+            options['sizes'] = DEFAULT_SIZES.get(options['scenario'], [10, 100, 1000])
+        SCENARIOS[options['scenario']](self, options)
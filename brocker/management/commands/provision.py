@@ -0,0 +1,66 @@
+import itertools
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from brocker.provisioning import (
+    DEFAULT_CHUNK_SIZE, FORMATS, ProvisioningError, provision, read_records,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk import tokens, tags and permissions from CSV or JSON Lines files "
+        "(columns/keys: token, name, max_connections, tag, permission)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help="Files to import, or '-' for standard input.")
+        parser.add_argument(
+            '--format', choices=FORMATS,
+            help="Input format. Taken from the file extension when omitted; required for standard input.",
+        )
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help="Rows per bulk query.")
+        parser.add_argument(
+            '--update-tokens', action='store_true',
+            help="Overwrite the name and max_connections of tokens that already exist.",
+        )
+        parser.add_argument('--dry-run', action='store_true', help="Validate and report without saving anything.")
+
+    def _format(self, path, options):
+        if options['format']:
+            return options['format']
+        extension = os.path.splitext(path)[1].lstrip('.').lower()
+        if extension in FORMATS:
+            return extension
+        raise CommandError(f"Cannot tell the format of '{path}'; pass --format.")
+
+    def handle(self, *args, **options):
+        streams = []
+        try:
+            for path in options['files']:
+                fmt = self._format(path, options)
+                stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+                streams.append((stream, fmt))
+            records = itertools.chain.from_iterable(read_records(stream, fmt) for stream, fmt in streams)
+
+            with transaction.atomic():
+                result = provision(
+                    records, chunk_size=options['chunk_size'], update_tokens=options['update_tokens'],
+                )
+                if options['dry_run']:
+                    transaction.set_rollback(True)
+        except (OSError, ProvisioningError) as exc:
+            raise CommandError(str(exc)) from exc
+        finally:
+            for stream, _ in streams:
+                if stream is not sys.stdin:
+                    stream.close()
+
+        prefix = "Dry run: would have provisioned" if options['dry_run'] else "Provisioned"
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} {result.tokens_created} new tokens, {result.tokens_updated} updated tokens, "
+            f"{result.tags_created} new tags and {result.permissions_written} permissions."
+        ))
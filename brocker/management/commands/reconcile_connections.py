@@ -0,0 +1,26 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from brocker.connection_counter import get_connection_counter
+
+
+class Command(BaseCommand):
+    help = "Drop expired connection leases and report live connections per token."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset', action='store_true',
+            help="Drop every lease. Only use this while no broker worker is running.",
+        )
+
+    def handle(self, *args, **options):
+        counts = asyncio.run(get_connection_counter().reconcile(reset=options['reset']))
+        if options['reset']:
+            self.stdout.write(self.style.SUCCESS("All connection leases dropped."))
+            return
+        for key, count in sorted(counts.items()):
+            self.stdout.write(f"{key}: {count}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Reconciled {len(counts)} tokens, {sum(counts.values())} live connections."
+        ))
@@ -1,8 +1,9 @@
 import logging
+import uuid
 from channels.middleware import BaseMiddleware
 from brocker.check_tags_permissions import check_tags_permissions
-from django.core.cache import cache
-from brocker.consumers import sanitize_tag
+from brocker.connection_counter import get_connection_counter
+from brocker.replay import parse_last_id
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +16,7 @@ class AuthMiddlewareBroker(BaseMiddleware):
 
         token_str = token.decode().split(' ')[1] if token and b' ' in token else token.decode() if token else None
         tags_str = tags_header.decode() if tags_header else None
+        last_id_header = headers.get(b'last-id', None)
 
         if not token_str or not tags_str:
             logger.warning(f"Connection rejected: Missing token or tags. IP: {scope.get('client')}")
@@ -28,27 +30,33 @@ class AuthMiddlewareBroker(BaseMiddleware):
             await send({"type": "websocket.close", "code": 4003})
             return
 
-        tag_permissions, max_connections = result
+        tag_permissions, max_connections, token_name, tag_ids = result
         
         if max_connections > 0:
-            safe_token = sanitize_tag(token_str)
-            cache_key = f"connections:{safe_token}"
-            
-            connection_count = cache.incr(cache_key, 1)
-
-            if connection_count > max_connections:
-                cache.decr(cache_key, 1)
-                
+            lease = uuid.uuid4().hex
+            connection_count = await get_connection_counter().acquire(token_str, max_connections, lease)
+
+            if connection_count is None:
                 logger.warning(
                     "Connection rejected for token %s: Connection limit reached (%s/%s)",
-                    token_str, connection_count - 1, max_connections
+                    token_str, max_connections, max_connections
                 )
                 await send({"type": "websocket.close", "code": 4004})
                 return
 
+            scope['connection_count'] = connection_count
+            scope['connection_lease'] = lease
+
         scope['tag_permissions'] = tag_permissions
+        scope['tag_ids'] = tag_ids
         scope['max_connections'] = max_connections
         scope['token'] = token_str
+        scope['token_name'] = token_name
+        scope['last_id'] = None
+        if last_id_header is not None:
+            scope['last_id'] = parse_last_id(last_id_header.decode(errors='replace'))
+            if scope['last_id'] is None:
+                logger.warning("Ignoring invalid Last-Id header %r from token %s", last_id_header, token_str)
 
         logger.info(f"Connection successful for token '{token_str}' with tags '{tags_str}'.")
         return await super().__call__(scope, receive, send)
\ No newline at end of file
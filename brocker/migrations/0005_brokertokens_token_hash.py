@@ -0,0 +1,28 @@
+# Generated by Django 5.2.9 on 2026-10-18 13:17
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def populate_token_hash(apps, schema_editor):
+    BrokerTokens = apps.get_model('brocker', 'BrokerTokens')
+    for broker in BrokerTokens.objects.only('id', 'token').iterator():
+        broker.token_hash = hashlib.sha256(broker.token.encode()).hexdigest()
+        broker.save(update_fields=['token_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brocker', '0004_brokertokens_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='brokertokens',
+            name='token_hash',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(populate_token_hash, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.9 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+# Rows written per bulk_update.
+BATCH_SIZE = 1000
+
+
+def literal_prefix(pattern):
+    # Frozen copy of brocker.topic_tree.literal_prefix: the levels before the
+    # first '+' anywhere in a level or a whole last level of '#'.
+    levels = pattern.split('/')
+    last = len(levels) - 1
+    for i, level in enumerate(levels):
+        if '+' in level or (level == '#' and i == last):
+            return '/'.join(levels[:i])
+    return pattern
+
+
+def populate_literal_prefix(apps, schema_editor):
+    BrokerTags = apps.get_model('brocker', 'BrokerTags')
+    batch = []
+    for tag in BrokerTags.objects.only('id', 'prefix').iterator(chunk_size=BATCH_SIZE):
+        tag.literal_prefix = literal_prefix(tag.prefix)
+        batch.append(tag)
+        if len(batch) == BATCH_SIZE:
+            BrokerTags.objects.bulk_update(batch, ['literal_prefix'])
+            batch = []
+    BrokerTags.objects.bulk_update(batch, ['literal_prefix'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brocker', '0005_brokertokens_token_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='brokertags',
+            name='literal_prefix',
+            field=models.TextField(blank=True, db_index=True, default='', editable=False),
+        ),
+        migrations.RunPython(populate_literal_prefix, migrations.RunPython.noop),
+    ]
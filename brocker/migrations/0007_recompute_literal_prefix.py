@@ -0,0 +1,42 @@
+from django.db import migrations
+
+# Rows written per bulk_update.
+BATCH_SIZE = 1000
+
+
+def literal_prefix(pattern):
+    # Frozen copy of brocker.topic_tree.literal_prefix: the levels before the
+    # first '+' anywhere in a level or a whole last level of '#'.
+    levels = pattern.split('/')
+    last = len(levels) - 1
+    for i, level in enumerate(levels):
+        if '+' in level or (level == '#' and i == last):
+            return '/'.join(levels[:i])
+    return pattern
+
+
+def recompute_literal_prefix(apps, schema_editor):
+    # Only '+' and '#' end the literal prefix now; prefixes containing other
+    # punctuation, such as '.', were stored shorter.
+    BrokerTags = apps.get_model('brocker', 'BrokerTags')
+    batch = []
+    for tag in BrokerTags.objects.only('id', 'prefix', 'literal_prefix').iterator(chunk_size=BATCH_SIZE):
+        literal = literal_prefix(tag.prefix)
+        if tag.literal_prefix != literal:
+            tag.literal_prefix = literal
+            batch.append(tag)
+        if len(batch) == BATCH_SIZE:
+            BrokerTags.objects.bulk_update(batch, ['literal_prefix'])
+            batch = []
+    BrokerTags.objects.bulk_update(batch, ['literal_prefix'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brocker', '0006_brokertags_literal_prefix'),
+    ]
+
+    operations = [
+        migrations.RunPython(recompute_literal_prefix, migrations.RunPython.noop),
+    ]
@@ -1,13 +1,35 @@
+import hashlib
 from django.db import models
-from brocker.MqttPatternMatcher import MqttPatternMatcher
+from django.db.models import Q
+from brocker import topic_tree
 from django.core.exceptions import ValidationError
 # Create your models here.
 class BrokerTokens(models.Model):
     name = models.CharField(max_length=255,null=True, blank=True)
     token = models.TextField(unique=True)
+    # sha256 of the token: a compact, fixed-width index for handshake lookups.
+    token_hash = models.CharField(max_length=64, db_index=True, editable=False, default='')
     max_connections = models.IntegerField(default=0)  # 0 for unlimited
+    _old_token = None
+
+    @staticmethod
+    def hash_token(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._old_token = self.token
+
     def __str__(self):
         return self.name if self.name else self.token
+
+    def save(self, *args, **kwargs):
+        self.token_hash = self.hash_token(self.token)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'token' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'token_hash'}
+        super().save(*args, **kwargs)
+        self._old_token = self.token
 class BrokerPermission(models.Model):
     PERMISSION_CHOICES = [
         ('read', 'Read'),
@@ -16,6 +38,13 @@ class BrokerPermission(models.Model):
     broker = models.ForeignKey(BrokerTokens, on_delete=models.CASCADE)
     tag = models.ForeignKey('BrokerTags', on_delete=models.CASCADE)
     permission = models.CharField(max_length=11, choices=PERMISSION_CHOICES)
+    _old_broker_id = None
+    _old_tag_id = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._old_broker_id = self.broker_id
+        self._old_tag_id = self.tag_id
 
     def __str__(self):
         return f"{self.broker} - {self.tag} ({self.permission})"
@@ -26,18 +55,40 @@ class BrokerPermission(models.Model):
         ]
 
     def save(self, *args, **kwargs):
-        if self.pk:
-            old = BrokerPermission.objects.get(pk=self.pk)
-            if old.broker != self.broker or old.tag != self.tag:
-                old.delete()
-                self.pk = None
+        # A permission moved to another token or tag keeps its row; the
+        # post_save handler tells the previous holder from the _old_ ids.
         super().save(*args, **kwargs)
+        self._old_broker_id = self.broker_id
+        self._old_tag_id = self.tag_id
+
+
+class BrokerTagsManager(models.Manager):
+
+    def bulk_create_validated(self, prefixes, batch_size=1000):
+        """
+        Create tags for many prefixes at once. The whole batch is checked
+        for overlaps against the existing tags and itself in one pass over
+        an in-memory PrefixIndex, and nothing is created if any overlaps.
+        """
+        index = topic_tree.PrefixIndex(self.values_list('prefix', flat=True))
+        tags = []
+        for prefix in prefixes:
+            conflict = index.find_overlap(prefix)
+            if conflict is not None:
+                raise ValidationError(f"Prefix '{prefix}' conflicts or overlaps with existing prefix '{conflict}'")
+            index.add(prefix)
+            tags.append(self.model(prefix=prefix, literal_prefix=topic_tree.literal_prefix(prefix)))
+        return self.bulk_create(tags, batch_size=batch_size)
 
 
 class BrokerTags(models.Model):
     prefix = models.TextField(unique=True)
+    # Levels of the prefix before its first wildcard, to narrow overlap checks.
+    literal_prefix = models.TextField(db_index=True, editable=False, blank=True, default='')
     _old_prefix = None
 
+    objects = BrokerTagsManager()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._old_prefix = self.prefix
@@ -46,14 +97,26 @@ class BrokerTags(models.Model):
         return self.prefix
 
     def clean(self):
-        matcher = MqttPatternMatcher()
-        existing_prefixes = BrokerTags.objects.exclude(id=self.id).values_list('prefix', flat=True)
+        # Only prefixes whose literal part leads to this one, or that start
+        # with its literal part, can overlap; see topic_tree.PrefixIndex.
+        existing_prefixes = BrokerTags.objects.exclude(id=self.id)
+        literal = topic_tree.literal_prefix(self.prefix)
+        if literal:
+            existing_prefixes = existing_prefixes.filter(
+                Q(literal_prefix__in=topic_tree.level_prefixes(self.prefix))
+                | Q(prefix=literal)
+                | Q(prefix__startswith=literal + '/')
+            )
 
-        for ep in existing_prefixes:
-            if matcher.is_match(self.prefix, [ep])["match"] or matcher.is_match(ep, [self.prefix])["match"]:
+        for ep in existing_prefixes.values_list('prefix', flat=True):
+            if topic_tree.patterns_overlap(self.prefix, ep):
                 raise ValidationError(f"Prefix '{self.prefix}' conflicts or overlaps with existing prefix '{ep}'")
 
     def save(self, *args, **kwargs):
+        self.literal_prefix = topic_tree.literal_prefix(self.prefix)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'prefix' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'literal_prefix'}
         self.full_clean()
         super().save(*args, **kwargs)
         self._old_prefix = self.prefix
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from brocker.consumers import token_group
+from brocker.models import BrokerTokens
+from brocker.permission_cache import INVALIDATION_GROUP, INVALIDATION_TYPE, permission_cache
+from brocker.worker_channel import worker_channel
+
+logger = logging.getLogger(__name__)
+
+# Message type carrying every change of one transaction to a token's connections.
+CHANGES_TYPE = "access_changes"
+
+# Group sends issued concurrently per step when notifying many tokens.
+NOTIFY_BATCH_SIZE = 500
+
+
+async def _send(channel_layer, tokens, revision, messages):
+    await channel_layer.group_send(
+        INVALIDATION_GROUP, {"type": INVALIDATION_TYPE, "tokens": tokens, "revision": revision},
+    )
+    for start in range(0, len(messages), NOTIFY_BATCH_SIZE):
+        await asyncio.gather(*(
+            channel_layer.group_send(token_group(token), message)
+            for token, message in messages[start:start + NOTIFY_BATCH_SIZE]
+        ))
+
+
+class PendingChanges:
+    """
+    Access changes recorded inside one transaction or savepoint, deduplicated
+    per token. Changes recorded by token id are resolved to their tokens on
+    flush.
+    """
+
+    def __init__(self):
+        self.changes = {}  # token -> {change key: change}
+        self.broker_changes = {}  # token id -> {change key: change}
+        # Set by bulk changes that drop every cached token instead.
+        self.invalidate_all = False
+
+    def add(self, tokens, change):
+        key = tuple(sorted(change.items()))
+        for token in tokens:
+            self.changes.setdefault(token, {})[key] = change
+
+    def add_for_brokers(self, broker_ids, change):
+        key = tuple(sorted(change.items()))
+        for broker_id in broker_ids:
+            self.broker_changes.setdefault(broker_id, {})[key] = change
+
+    def merge(self, other):
+        for token, changes in other.changes.items():
+            self.changes.setdefault(token, {}).update(changes)
+        self.invalidate_all = self.invalidate_all or other.invalidate_all
+
+    def _resolve_brokers(self):
+        # Tokens deleted since were told by their own token_update.
+        rows = BrokerTokens.objects.filter(pk__in=list(self.broker_changes)).values_list('pk', 'token')
+        for broker_id, token in rows:
+            self.changes.setdefault(token, {}).update(self.broker_changes[broker_id])
+        self.broker_changes = {}
+
+    def flush(self):
+        """
+        Drop the cached permissions of every affected token on this worker
+        and queue the changes to be sent in the background.
+        """
+        if self.broker_changes:
+            self._resolve_brokers()
+        if not self.changes and not self.invalidate_all:
+            return
+        permission_cache.invalidate(None if self.invalidate_all else list(self.changes))
+        _post(self)
+
+
+# Flushed changes not sent yet. Changes flushed before the previous batch
+# was taken are sent together, so the committed savepoints of a transaction
+# reach each token in one message.
+_outbox = None
+_outbox_lock = threading.Lock()
+
+# Notifications are sent from this thread when the worker's event loop is
+# not running, so that the code that changed the data does not wait for them.
+_notify_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="brocker-notify")
+
+
+def _post(pending):
+    global _outbox
+    with _outbox_lock:
+        if _outbox is not None:
+            _outbox.merge(pending)
+            return
+        _outbox = pending
+    _submit()
+
+
+def _submit():
+    # The in-memory channel layer only works from the loop its consumers
+    # run on, which is the one the worker channel runs on.
+    loop = worker_channel.loop
+    if loop is not None and loop.is_running():
+        asyncio.run_coroutine_threadsafe(_deliver(), loop)
+    else:
+        _notify_executor.submit(async_to_sync(_deliver))
+
+
+async def _deliver():
+    """
+    Send every token in the outbox one message with all of its changes, and
+    every worker one cache invalidation listing them.
+    """
+    global _outbox
+    with _outbox_lock:
+        pending, _outbox = _outbox, None
+    channel_layer = get_channel_layer()
+    if pending is None or channel_layer is None:
+        return
+    tokens = None if pending.invalidate_all else list(pending.changes)
+    # Lets every socket of a token on a worker share one reload of its
+    # permissions for this change; see get_token_permissions.
+    revision = uuid.uuid4().hex
+    messages = [
+        (token, {"type": CHANGES_TYPE, "revision": revision, "changes": list(changes.values())})
+        for token, changes in pending.changes.items()
+    ]
+    logger.info("Notifying %d tokens of access changes.", len(messages))
+    try:
+        await _send(channel_layer, tokens, revision, messages)
+    except Exception:
+        logger.exception("Failed to notify %d tokens of access changes", len(messages))
+
+
+def _pending_changes(connection):
+    """
+    Returns the pending set of the innermost savepoint or transaction of
+    connection. Each set is flushed by one on_commit callback, registered
+    when the set is created, which Django discards along with the savepoint
+    or transaction when that is rolled back.
+    """
+    pending_sets = getattr(connection, '_brocker_pending_changes', None)
+    if pending_sets is None:
+        pending_sets = connection._brocker_pending_changes = {}
+    key = tuple(sid for sid in connection.savepoint_ids if sid is not None)
+    callbacks = [func for _, func, _ in connection.run_on_commit]
+    pending = pending_sets.get(key)
+    if pending is not None and pending.flush in callbacks:
+        return pending
+    # Sets whose callback is gone were rolled back or already flushed.
+    for other_key, other in list(pending_sets.items()):
+        if other.flush not in callbacks:
+            del pending_sets[other_key]
+    pending = pending_sets[key] = PendingChanges()
+    transaction.on_commit(pending.flush, using=connection.alias, robust=True)
+    return pending
+
+
+def _current_changes():
+    """
+    Returns the pending changes of the current savepoint or transaction and
+    whether they must be flushed right away because there is none.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return PendingChanges(), True
+    return _pending_changes(connection), False
+
+
+def record_change(tokens, change):
+    """
+    Notify the connections of tokens of an access change (a control message
+    for BrokerConsumer such as {"type": "token_update"}) once the current
+    transaction commits, or right away outside of a transaction.
+    """
+    pending, immediate = _current_changes()
+    pending.add(tokens, change)
+    if immediate:
+        pending.flush()
+
+
+def record_broker_change(broker_ids, change):
+    """
+    record_change for the tokens with the given ids, looked up once the
+    transaction commits, for changes whose tokens are not at hand.
+    """
+    pending, immediate = _current_changes()
+    pending.add_for_brokers(broker_ids, change)
+    if immediate:
+        pending.flush()
+
+
+def record_changes(changes):
+    """
+    record_change for many (tokens, change) pairs at once, as one pending
+    set, for bulk operations.
+    """
+    pending, immediate = _current_changes()
+    for tokens, change in changes:
+        pending.add(tokens, change)
+    if immediate:
+        pending.flush()
+
+
+def record_invalidation():
+    """
+    Drop the cached permissions of every token on every worker once the
+    current transaction commits. Used by bulk changes that send no signals.
+    """
+    pending, immediate = _current_changes()
+    pending.invalidate_all = True
+    if immediate:
+        pending.flush()
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache
+
+from brocker.conf import get_setting
+from brocker.topic_tree import TopicTree
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+CONFLATE = 'conflate'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, CONFLATE, DISCONNECT)
+
+# Close code used by the 'disconnect' policy.
+SLOW_CONSUMER_CLOSE_CODE = 4005
+
+# Frames dropped by all connections of this worker, per policy.
+dropped_frames = Counter()
+
+
+@lru_cache(maxsize=None)
+def _batch_tag_index():
+    return TopicTree((pattern, True) for pattern in get_setting('BATCH_TAGS'))
+
+
+@lru_cache(maxsize=4096)
+def is_batched_tag(tag):
+    """
+    Whether messages on tag are delivered in batches (BROCKER_BATCH_TAGS).
+    """
+    return _batch_tag_index().match(tag) is not None
+
+
+def is_batched_token(token_name):
+    """
+    Whether every message to a token is delivered in batches (BROCKER_BATCH_TOKENS).
+    """
+    return token_name is not None and token_name in get_setting('BATCH_TOKENS')
+
+
+class OutboundQueue:
+    """
+    A bounded queue of frames waiting to be written to one WebSocket.
+
+    Channel-layer handlers enqueue without waiting for the client; a writer
+    task drains the queue. When the client falls behind and the queue is
+    full, the configured policy decides what is lost, so one slow reader
+    never backs up the worker's channel-layer inbox.
+
+    Frames enqueued with batch=True are held for up to max_delay_ms or until
+    max_messages are pending and then written as a single array frame built
+    by join_frames.
+    """
+
+    def __init__(self, send, close, maxsize=None, policy=None,
+                 join_frames=None, max_messages=None, max_delay_ms=None):
+        self.maxsize = maxsize if maxsize is not None else get_setting('OUTBOUND_QUEUE_SIZE')
+        self.policy = policy or get_setting('OUTBOUND_POLICY')
+        if self.policy not in POLICIES:
+            raise ValueError(f"Unknown outbound policy '{self.policy}', expected one of {POLICIES}")
+        self.dropped = 0
+        self._send = send
+        self._close = close
+        self._join_frames = join_frames
+        self.max_messages = max_messages if max_messages is not None else get_setting('BATCH_MAX_MESSAGES')
+        max_delay_ms = max_delay_ms if max_delay_ms is not None else get_setting('BATCH_MAX_DELAY_MS')
+        self.max_delay = max_delay_ms / 1000
+        # Conflation needs to find the pending frame of a tag.
+        self._frames = OrderedDict() if self.policy == CONFLATE else deque()
+        self._ready = asyncio.Event()
+        # Set whenever the writer has emptied the queue; see join().
+        self._drained = asyncio.Event()
+        self._closed = False
+        self._close_task = None
+        self._writer = asyncio.get_running_loop().create_task(self._write_forever())
+
+    def __len__(self):
+        return len(self._frames)
+
+    def _drop(self, count=1):
+        self.dropped += count
+        dropped_frames[self.policy] += count
+
+    def put(self, tag, frame, batch=False):
+        """
+        Enqueue a frame (str for text, bytes for binary) without waiting.
+        """
+        if self._closed:
+            return
+
+        frame = (frame, batch and self._join_frames is not None)
+        frames = self._frames
+        if self.policy == CONFLATE:
+            if tag in frames:
+                # Replacing the pending frame of a tag is the policy's
+                # normal operation, not a loss to capacity.
+                frames[tag] = frame
+                return
+            frames[tag] = frame
+            if len(frames) > self.maxsize:
+                frames.popitem(last=False)
+                self._drop()
+        elif len(frames) < self.maxsize:
+            frames.append(frame)
+        elif self.policy == DROP_OLDEST:
+            frames.popleft()
+            frames.append(frame)
+            self._drop()
+        elif self.policy == DROP_NEWEST:
+            self._drop()
+        else:
+            logger.warning("Closing slow consumer: outbound queue full (%d frames)", self.maxsize)
+            self.disconnect(dropped=1)
+            return
+
+        self._ready.set()
+
+    def _pop(self):
+        if self.policy == CONFLATE:
+            return self._frames.popitem(last=False)[1]
+        return self._frames.popleft()
+
+    def _next_is_batched(self):
+        if self.policy == CONFLATE:
+            return next(iter(self._frames.values()))[1]
+        return self._frames[0][1]
+
+    async def _collect_batch(self, first):
+        """
+        Gather batched frames following first until the batch is full, its
+        delay is over, or an unbatched frame comes next.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        frames = [first]
+        while len(frames) < self.max_messages:
+            if self._frames:
+                if not self._next_is_batched():
+                    break
+                frames.append(self._pop()[0])
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return self._join_frames(frames)
+
+    async def _write_forever(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self._frames:
+                    frame, batch = self._pop()
+                    if batch:
+                        frame = await self._collect_batch(frame)
+                    if isinstance(frame, bytes):
+                        await self._send(bytes_data=frame)
+                    else:
+                        await self._send(text_data=frame)
+                self._ready.clear()
+                self._drained.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Outbound writer stopped")
+            self._closed = True
+            self._drained.set()
+
+    async def join(self):
+        """
+        Wait until every queued frame was written or the queue was closed,
+        for producers that must not outrun the client.
+        """
+        while self._frames and not self._closed:
+            self._drained.clear()
+            await self._drained.wait()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def disconnect(self, dropped=0):
+        """
+        Discard pending frames and close the connection as a slow consumer.
+        dropped counts the frames lost besides the pending ones.
+        """
+        self._drop(len(self._frames) + dropped)
+        self._frames.clear()
+        self._closed = True
+        self._drained.set()
+        self._close_task = asyncio.get_running_loop().create_task(self._close(code=SLOW_CONSUMER_CLOSE_CODE))
+
+    def close(self):
+        """
+        Stop writing and discard pending frames.
+        """
+        self._closed = True
+        self._frames.clear()
+        self._writer.cancel()
+        self._drained.set()
@@ -0,0 +1,148 @@
+import logging
+import time
+from collections import OrderedDict, deque, namedtuple
+
+from brocker.conf import get_setting
+from brocker.worker_channel import worker_channel
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_GROUP = "brocker.permission_cache"
+INVALIDATION_TYPE = "permission_cache.invalidate"
+
+# Name and max_connections of the token and the TopicTree of its permissions,
+# with the revision of the access change it was reloaded for, if any.
+TokenPermissions = namedtuple(
+    'TokenPermissions', ['name', 'max_connections', 'index', 'revision'], defaults=[None],
+)
+
+# Invalidations remembered with their revision; see PermissionCache.set().
+RECENT_INVALIDATIONS = 64
+
+# Cached marker for tokens that do not exist, so repeated handshakes with an
+# unknown token do not reach the database either.
+MISSING = object()
+
+
+class PermissionCache:
+    """
+    A per-process LRU of token -> TokenPermissions with a time-to-live.
+
+    Entries are dropped on expiry, when the cache grows past its size bound,
+    or when an invalidation is broadcast by the model signals. Unknown tokens
+    are kept in a separate, smaller LRU, so a flood of random tokens cannot
+    evict the entries of valid ones.
+    """
+
+    def __init__(self, ttl=None, max_size=None, missing_size=None):
+        self.ttl = ttl if ttl is not None else get_setting('PERMISSION_CACHE_TTL')
+        self.max_size = max_size if max_size is not None else get_setting('PERMISSION_CACHE_SIZE')
+        self.missing_size = (
+            missing_size if missing_size is not None else get_setting('PERMISSION_CACHE_MISSING_SIZE')
+        )
+        self._entries = OrderedDict()
+        self._missing = OrderedDict()  # token -> expiry, for tokens cached as MISSING
+        # Bumped on every invalidation so a load that raced with one is not
+        # stored; see set().
+        self.generation = 0
+        self._recent = deque(maxlen=RECENT_INVALIDATIONS)  # (generation, revision)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, token):
+        """
+        Returns the cached entry (possibly MISSING), or None on a cache miss.
+        """
+        item = self._entries.get(token)
+        if item is None:
+            expires_at = self._missing.get(token)
+            if expires_at is None:
+                return None
+            if expires_at < time.monotonic():
+                del self._missing[token]
+                return None
+            self._missing.move_to_end(token)
+            return MISSING
+        expires_at, entry = item
+        if expires_at < time.monotonic():
+            del self._entries[token]
+            return None
+        self._entries.move_to_end(token)
+        return entry
+
+    def _only_revision_since(self, generation, revision):
+        # Whether every invalidation after generation was sent for revision.
+        if revision is None or generation < self.generation - len(self._recent):
+            return False
+        return all(seen == revision for number, seen in self._recent if number > generation)
+
+    def set(self, token, entry, generation=None, revision=None):
+        """
+        Stores an entry. When generation is given and an invalidation happened
+        since it was read, the entry may be stale and is not stored, unless
+        it was loaded for an access change revision and every invalidation
+        since was sent for that same revision.
+        """
+        if self.ttl <= 0:
+            return
+        if (generation is not None and generation != self.generation
+                and not self._only_revision_since(generation, revision)):
+            return
+        expires_at = time.monotonic() + self.ttl
+        if entry is MISSING:
+            self._entries.pop(token, None)
+            if self.missing_size <= 0:
+                return
+            self._missing[token] = expires_at
+            self._missing.move_to_end(token)
+            while len(self._missing) > self.missing_size:
+                self._missing.popitem(last=False)
+            return
+
+        self._missing.pop(token, None)
+        if self.max_size <= 0:
+            return
+        self._entries[token] = (expires_at, entry)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, tokens=None, revision=None):
+        """
+        Drops the given tokens, or everything when tokens is None. Entries
+        already reloaded for the given access change revision are kept.
+        """
+        self.generation += 1
+        self._recent.append((self.generation, revision))
+        if tokens is None:
+            self._entries.clear()
+            self._missing.clear()
+            return
+        for token in tokens:
+            self._missing.pop(token, None)
+            item = self._entries.get(token)
+            if item is None:
+                continue
+            if revision is None or item[1].revision != revision:
+                del self._entries[token]
+
+
+permission_cache = PermissionCache()
+
+
+async def _handle_invalidation(message):
+    tokens = message.get("tokens")
+    logger.debug("Invalidating cached permissions for: %s", tokens if tokens is not None else "all tokens")
+    permission_cache.invalidate(tokens, message.get("revision"))
+
+
+worker_channel.register(INVALIDATION_TYPE, _handle_invalidation)
+
+
+async def listen_for_invalidations():
+    """
+    Join this worker to the invalidation group. Cheap after the first call.
+    """
+    await worker_channel.group_add(INVALIDATION_GROUP)
+
@@ -0,0 +1,208 @@
+import csv
+import json
+import logging
+from collections import namedtuple
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from brocker.models import BrokerPermission, BrokerTags, BrokerTokens
+from brocker.notifications import record_changes, record_invalidation
+
+logger = logging.getLogger(__name__)
+
+# Rows written per bulk query.
+DEFAULT_CHUNK_SIZE = 1000
+
+FORMATS = ('csv', 'jsonl')
+
+PERMISSIONS = {choice for choice, _ in BrokerPermission.PERMISSION_CHOICES}
+
+ProvisionResult = namedtuple(
+    'ProvisionResult',
+    ['tokens_created', 'tokens_updated', 'tags_created', 'permissions_written'],
+)
+
+
+class ProvisioningError(ValueError):
+    """
+    Raised for an invalid record; nothing is written.
+    """
+
+
+def read_records(stream, format):
+    """
+    Yield provisioning records from a text stream of CSV (with a header
+    row) or JSON Lines.
+
+    Every record has a 'token' and optionally 'name', 'max_connections',
+    'tag' and 'permission'. A record with a tag grants the token that
+    permission on the tag, creating the tag if needed.
+    """
+    if format == 'csv':
+        for record in csv.DictReader(stream):
+            yield {key: value for key, value in record.items() if value not in (None, '')}
+    elif format == 'jsonl':
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as exc:
+                raise ProvisioningError(f"Line {line_number}: {exc}") from exc
+            if not isinstance(record, dict):
+                raise ProvisioningError(f"Line {line_number}: expected an object")
+            yield record
+    else:
+        raise ProvisioningError(f"Unknown format '{format}', expected one of {FORMATS}")
+
+
+def _string(record, field, number):
+    value = record.get(field)
+    if value is not None and not isinstance(value, str):
+        raise ProvisioningError(f"Record {number}: {field} must be a string")
+    return value
+
+
+def _collect(records):
+    tokens = {}       # token -> {'name': ..., 'max_connections': ...}
+    tags = {}         # prefix -> None, in first-seen order
+    permissions = {}  # (token, prefix) -> permission
+
+    for number, record in enumerate(records, 1):
+        token = _string(record, 'token', number)
+        if not token:
+            raise ProvisioningError(f"Record {number}: missing token")
+        fields = tokens.setdefault(token, {})
+        name = _string(record, 'name', number)
+        if name is not None:
+            fields['name'] = name
+        max_connections = record.get('max_connections')
+        if max_connections is not None:
+            try:
+                if isinstance(max_connections, bool):
+                    raise TypeError
+                max_connections = int(max_connections)
+            except (TypeError, ValueError):
+                raise ProvisioningError(f"Record {number}: invalid max_connections") from None
+            if max_connections < 0:
+                raise ProvisioningError(f"Record {number}: max_connections must not be negative")
+            fields['max_connections'] = max_connections
+
+        tag = _string(record, 'tag', number)
+        if tag:
+            permission = _string(record, 'permission', number) or 'read'
+            if permission not in PERMISSIONS:
+                raise ProvisioningError(f"Record {number}: invalid permission '{permission}'")
+            tags[tag] = None
+            permissions[token, tag] = permission
+
+    return tokens, list(tags), permissions
+
+
+def _chunks(values, size):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _ids(model, field, values, chunk_size):
+    ids = {}
+    for chunk in _chunks(values, chunk_size):
+        ids.update(model.objects.filter(**{f'{field}__in': chunk}).values_list(field, 'id'))
+    return ids
+
+
+def provision(records, chunk_size=DEFAULT_CHUNK_SIZE, update_tokens=False):
+    """
+    Create or update tokens, tags and permissions from records in bulk.
+
+    Runs in one transaction with bulk queries of chunk_size rows and no
+    per-row model signals. New tags are checked for overlaps in one pass.
+    Existing permissions of a token on a tag are overwritten, and the name
+    and max_connections of existing tokens are too when update_tokens is
+    True. Once committed, every worker drops its cached permissions, and
+    connections of existing tokens whose permissions changed re-check them;
+    those of updated tokens get the usual token_update.
+
+    Returns a ProvisionResult with the number of rows written.
+    """
+    tokens, tags, permissions = _collect(records)
+
+    with transaction.atomic():
+        existing_tags = _ids(BrokerTags, 'prefix', tags, chunk_size)
+        new_tags = [tag for tag in tags if tag not in existing_tags]
+        try:
+            BrokerTags.objects.bulk_create_validated(new_tags, batch_size=chunk_size)
+        except ValidationError as exc:
+            raise ProvisioningError(exc.messages[0]) from exc
+
+        token_ids = _ids(BrokerTokens, 'token', tokens, chunk_size)
+        new_tokens = [
+            BrokerTokens(
+                token=token,
+                token_hash=BrokerTokens.hash_token(token),
+                name=fields.get('name'),
+                max_connections=fields.get('max_connections', 0),
+            )
+            for token, fields in tokens.items() if token not in token_ids
+        ]
+        BrokerTokens.objects.bulk_create(new_tokens, batch_size=chunk_size)
+
+        # Control messages for connections of existing tokens, sent once
+        # the transaction commits.
+        changes = []
+        updated_tokens = []
+        if update_tokens and token_ids:
+            for chunk in _chunks(token_ids, chunk_size):
+                batch = []
+                for broker in BrokerTokens.objects.filter(token__in=chunk):
+                    fields = tokens[broker.token]
+                    name = fields.get('name', broker.name)
+                    max_connections = fields.get('max_connections', broker.max_connections)
+                    if (name, max_connections) != (broker.name, broker.max_connections):
+                        broker.name, broker.max_connections = name, max_connections
+                        batch.append(broker)
+                BrokerTokens.objects.bulk_update(batch, ['name', 'max_connections'])
+                updated_tokens.extend(batch)
+            if updated_tokens:
+                changes.append(([broker.token for broker in updated_tokens], {"type": "token_update"}))
+
+        # Permissions of tokens that existed before, to notify their
+        # connections of the ones that change.
+        existing_token_ids = set(token_ids.values())
+        current = {}
+        for chunk in _chunks(existing_token_ids, chunk_size):
+            rows = BrokerPermission.objects.filter(broker_id__in=chunk).values_list('broker_id', 'tag_id', 'permission')
+            current.update(((broker_id, tag_id), permission) for broker_id, tag_id, permission in rows)
+
+        token_ids = _ids(BrokerTokens, 'token', tokens, chunk_size)
+        tag_ids = _ids(BrokerTags, 'prefix', tags, chunk_size)
+        rows = []
+        for (token, tag), permission in permissions.items():
+            key = (token_ids[token], tag_ids[tag])
+            if current.get(key) == permission:
+                continue
+            rows.append(BrokerPermission(broker_id=key[0], tag_id=key[1], permission=permission))
+            if key[0] in existing_token_ids:
+                changes.append(([token], {
+                    "type": "permission_update", "tag_id": key[1], "pattern": tag, "permission": permission,
+                }))
+
+        BrokerPermission.objects.bulk_create(
+            rows,
+            batch_size=chunk_size,
+            update_conflicts=True,
+            unique_fields=['broker', 'tag'],
+            update_fields=['permission'],
+        )
+        # bulk_create sends no signals; one invalidation covers every token,
+        # including new ones a failed handshake cached as missing.
+        record_changes(changes)
+        record_invalidation()
+
+    result = ProvisionResult(len(new_tokens), len(updated_tokens), len(new_tags), len(rows))
+    logger.info(
+        "Provisioned %d new tokens, %d updated tokens, %d new tags and %d permissions.", *result
+    )
+    return result
@@ -0,0 +1,263 @@
+import asyncio
+import bisect
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from functools import lru_cache
+
+from brocker.async_helpers import matcher
+from brocker.codecs import get_binary_codec
+from brocker.conf import get_setting
+from brocker.topic_tree import TopicTree, literal_prefix
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "replay:"
+# One counter for every tag, so that a single last id orders the messages
+# of all the tags of a connection.
+SEQUENCE_KEY = f"{KEY_PREFIX}sequence"
+# Sorted set of tags with equal scores, for lexicographic range lookups by
+# the literal prefix of a wildcard subscription.
+TAGS_KEY = f"{KEY_PREFIX}tags"
+
+# Append messages to the stream of a tag, trimmed to about maxlen entries.
+# Entry ids are 0-<sequence>. Returns the sequence of each message.
+#
+# KEYS = stream, sequence, tags; ARGV = tag, maxlen, ttl, then the messages.
+APPEND_SCRIPT = """
+local ids = {}
+for i = 4, #ARGV do
+    local id = redis.call('INCR', KEYS[2])
+    redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], '0-' .. id, 'm', ARGV[i])
+    ids[#ids + 1] = id
+end
+if tonumber(ARGV[3]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+redis.call('ZADD', KEYS[3], 0, ARGV[1])
+return ids
+"""
+
+
+def stream_key(tag):
+    return f"{KEY_PREFIX}stream:{tag}"
+
+
+@lru_cache(maxsize=None)
+def _replay_tag_index():
+    return TopicTree((pattern, True) for pattern in get_setting('REPLAY_TAGS'))
+
+
+@lru_cache(maxsize=4096)
+def is_replayed_tag(tag):
+    """
+    Whether messages on tag are kept for replay (BROCKER_REPLAY_TAGS).
+    """
+    return _replay_tag_index().match(tag) is not None
+
+
+def parse_last_id(value):
+    """
+    The message id a client sent in its Last-Id header, or None if it is
+    not a valid id.
+    """
+    try:
+        last_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    return last_id if last_id >= 0 else None
+
+
+class BaseReplayBuffer:
+    """
+    Keeps the last REPLAY_MAXLEN messages of each tag matching
+    BROCKER_REPLAY_TAGS, numbered by one increasing id across all tags, so a
+    reconnecting client can get the messages published after the last id it
+    received.
+
+    A tag's buffer is dropped REPLAY_TTL seconds after its last message.
+
+    Ids are taken before a message is sent, so live messages of concurrent
+    publishes on different tags may reach a client out of id order. A client
+    resuming from the highest id it got may then miss a lower one that was
+    still on its way.
+    """
+
+    def __init__(self):
+        self.maxlen = get_setting('REPLAY_MAXLEN')
+        self.ttl = get_setting('REPLAY_TTL')
+        self.batch_size = get_setting('REPLAY_BATCH_SIZE')
+        self.max_messages = get_setting('REPLAY_MAX_MESSAGES')
+
+    async def append(self, tag, messages):
+        """
+        Buffer messages published on tag. Returns the id of each message.
+        """
+        return await self._append(tag, messages)
+
+    async def replay(self, subscriptions, last_id):
+        """
+        Yields (tag, [(id, message), ...]) runs of the buffered messages with
+        an id above last_id, on the subscribed tags and every tag matched by
+        a subscribed pattern, in id order across all the tags. Stops after
+        REPLAY_MAX_MESSAGES messages, so a client that resumes from the last
+        id it got misses none.
+        """
+        exact = {tag for tag in subscriptions if literal_prefix(tag) == tag}
+        patterns = [tag for tag in subscriptions if literal_prefix(tag) != tag]
+        tags = {tag for tag in exact if is_replayed_tag(tag)}
+        if patterns:
+            compiled = [matcher.compile(pattern) for pattern in patterns]
+            for tag in await self._candidates(patterns):
+                if tag not in tags and any(pattern.match(tag) for pattern in compiled):
+                    tags.add(tag)
+
+        # One cursor per tag, (id of its next message, tag, batch, index in
+        # batch), merged by id. Ids are unique, so tags never get compared.
+        remaining = self.max_messages
+        tags = sorted(tags)
+        # The first reads share the limit, so many tags don't read far past it.
+        count = min(self.batch_size, max(1, remaining // max(1, len(tags))))
+        batches = await asyncio.gather(*(self._read(tag, last_id, count) for tag in tags))
+        cursors = [(entries[0][0], tag, entries, 0) for tag, entries in zip(tags, batches) if entries]
+        heapq.heapify(cursors)
+        while cursors and remaining > 0:
+            _, tag, entries, start = heapq.heappop(cursors)
+            # The run of this tag up to the next message of another one.
+            end = len(entries)
+            if cursors:
+                end = bisect.bisect_left(entries, cursors[0][0], lo=start, key=_entry_id)
+            end = min(end, start + remaining)
+            remaining -= end - start
+            yield tag, entries[start:end]
+            if end == len(entries) and remaining > 0:
+                entries = await self._read(tag, entries[-1][0], min(self.batch_size, remaining))
+                end = 0
+            if end < len(entries):
+                heapq.heappush(cursors, (entries[end][0], tag, entries, end))
+        if remaining <= 0:
+            logger.info("Replay limit of %d messages reached", self.max_messages)
+
+
+def _entry_id(entry):
+    return entry[0]
+
+
+def _sequence(entry_id):
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    return int(entry_id.partition('-')[2])
+
+
+class RedisReplayBuffer(BaseReplayBuffer):
+    """
+    Keeps each tag's messages in a Redis stream capped with MAXLEN, shared
+    by every worker.
+    """
+
+    def __init__(self, url, max_connections):
+        super().__init__()
+        from redis.asyncio import BlockingConnectionPool, Redis
+        self._redis = Redis(connection_pool=BlockingConnectionPool.from_url(url, max_connections=max_connections))
+        self._append_script = self._redis.register_script(APPEND_SCRIPT)
+
+    async def _append(self, tag, messages):
+        dumps = get_binary_codec().dumps
+        return await self._append_script(
+            keys=[stream_key(tag), SEQUENCE_KEY, TAGS_KEY],
+            args=[tag, self.maxlen, self.ttl, *(dumps(message) for message in messages)],
+        )
+
+    async def _read(self, tag, after, count):
+        entries = await self._redis.xrange(stream_key(tag), min=f"(0-{after}", max="+", count=count)
+        loads = get_binary_codec().loads
+        return [(_sequence(entry_id), loads(fields[b'm'])) for entry_id, fields in entries]
+
+    async def _candidates(self, patterns):
+        # Tags matching a pattern are its literal prefix itself or start
+        # with it and a level separator ('0' sorts right after '/').
+        # A pattern without one needs every tag, which covers the others.
+        prefixes = {literal_prefix(pattern) for pattern in patterns}
+        async with self._redis.pipeline(transaction=False) as pipe:
+            if '' in prefixes:
+                pipe.zrangebylex(TAGS_KEY, "-", "+")
+            else:
+                for prefix in prefixes:
+                    pipe.zrangebylex(TAGS_KEY, f"[{prefix}", f"[{prefix}")
+                    pipe.zrangebylex(TAGS_KEY, f"[{prefix}/", f"({prefix}0")
+            results = await pipe.execute()
+        tags = sorted({
+            tag.decode() if isinstance(tag, bytes) else tag
+            for found in results for tag in found
+        })
+        if not tags:
+            return tags
+
+        # Streams expire on their own; forget the tags whose stream is gone.
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for tag in tags:
+                pipe.exists(stream_key(tag))
+            exists = await pipe.execute()
+        expired = [tag for tag, found in zip(tags, exists) if not found]
+        if expired:
+            await self._redis.zrem(TAGS_KEY, *expired)
+        return [tag for tag, found in zip(tags, exists) if found]
+
+
+class LocalReplayBuffer(BaseReplayBuffer):
+    """
+    In-process counterpart of RedisReplayBuffer for single-worker setups.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._ids = itertools.count(1)
+        self._buffers = {}  # tag -> (last append time, deque of (id, message))
+
+    def _live(self, tag):
+        item = self._buffers.get(tag)
+        if item is None:
+            return None
+        appended_at, entries = item
+        if self.ttl > 0 and appended_at <= time.monotonic() - self.ttl:
+            del self._buffers[tag]
+            return None
+        return entries
+
+    async def _append(self, tag, messages):
+        entries = self._live(tag)
+        if entries is None:
+            entries = deque(maxlen=self.maxlen)
+        ids = [next(self._ids) for _ in messages]
+        entries.extend(zip(ids, messages))
+        self._buffers[tag] = (time.monotonic(), entries)
+        return ids
+
+    async def _read(self, tag, after, count):
+        entries = self._live(tag) or ()
+        start = bisect.bisect_right(entries, after, key=lambda entry: entry[0])
+        return list(itertools.islice(entries, start, start + count))
+
+    async def _candidates(self, patterns):
+        prefixes = [literal_prefix(pattern) for pattern in patterns]
+        return [
+            tag for tag in list(self._buffers)
+            if self._live(tag) is not None
+            and any(not prefix or tag == prefix or tag.startswith(prefix + '/') for prefix in prefixes)
+        ]
+
+
+_buffer = None
+
+
+def get_replay_buffer():
+    global _buffer
+    if _buffer is None:
+        url = get_setting('REDIS_URL')
+        if url:
+            _buffer = RedisReplayBuffer(url, get_setting('REDIS_MAX_CONNECTIONS'))
+        else:
+            _buffer = LocalReplayBuffer()
+    return _buffer
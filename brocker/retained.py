@@ -0,0 +1,295 @@
+import logging
+import time
+from collections import OrderedDict
+
+from brocker.async_helpers import matcher
+from brocker.codecs import get_binary_codec
+from brocker.conf import get_setting
+from brocker.topic_tree import literal_prefix
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "retained:"
+# Hash of tag -> its last retained message (and replay id), as MessagePack.
+MESSAGES_KEY = f"{KEY_PREFIX}messages"
+# Sorted set of tag -> time it was last retained, for expiry and eviction.
+UPDATED_KEY = f"{KEY_PREFIX}updated"
+# Sorted set of tags with equal scores, for lexicographic range lookups by
+# the literal prefix of a wildcard subscription.
+TAGS_KEY = f"{KEY_PREFIX}tags"
+
+# Entries pruned per write, to keep each script run short.
+PRUNE_BATCH_SIZE = 100
+
+# Store the message of a tag, then drop expired tags and the least recently
+# retained ones past the cap.
+#
+# KEYS = messages, updated, tags; ARGV = tag, message, ttl, max tags, batch.
+SET_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local ttl = tonumber(ARGV[3])
+local max_tags = tonumber(ARGV[4])
+local batch = tonumber(ARGV[5])
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], now, ARGV[1])
+redis.call('ZADD', KEYS[3], 0, ARGV[1])
+
+local function drop(tags)
+    if #tags > 0 then
+        redis.call('HDEL', KEYS[1], unpack(tags))
+        redis.call('ZREM', KEYS[2], unpack(tags))
+        redis.call('ZREM', KEYS[3], unpack(tags))
+    end
+end
+
+if ttl > 0 then
+    drop(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now - ttl, 'LIMIT', 0, batch))
+end
+local excess = redis.call('ZCARD', KEYS[2]) - max_tags
+if excess > 0 then
+    drop(redis.call('ZRANGE', KEYS[2], 0, math.min(excess, batch) - 1))
+end
+return 1
+"""
+
+# Message of each tag, or false for tags with nothing retained or expired.
+#
+# KEYS = messages, updated; ARGV = ttl, then the tags.
+GET_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local ttl = tonumber(ARGV[1])
+local found = {}
+for i = 2, #ARGV do
+    local message = false
+    local updated = redis.call('ZSCORE', KEYS[2], ARGV[i])
+    if updated and (ttl <= 0 or tonumber(updated) > now - ttl) then
+        message = redis.call('HGET', KEYS[1], ARGV[i])
+    end
+    found[i - 1] = message
+end
+return found
+"""
+
+# Cached marker for tags with nothing retained.
+MISSING = object()
+
+
+def is_pattern(tag):
+    return literal_prefix(tag) != tag
+
+
+class BaseRetainedStore:
+    """
+    Keeps the last message published with the retain flag on each tag, so
+    that new subscribers get it right after connecting.
+
+    Each tag expires RETAINED_TTL seconds after its last retained message,
+    and only the RETAINED_MAX_TAGS most recently retained tags are kept.
+    """
+
+    def __init__(self):
+        self.ttl = get_setting('RETAINED_TTL')
+        self.max_tags = get_setting('RETAINED_MAX_TAGS')
+        self.max_bytes = get_setting('RETAINED_MAX_BYTES')
+
+    @property
+    def enabled(self):
+        return self.max_tags > 0
+
+    async def set(self, tag, entry):
+        """
+        Retain a message entry ({'message': ..., 'id': ...}) as the last one
+        on tag. Messages larger than RETAINED_MAX_BYTES in MessagePack are
+        not retained.
+        """
+        if not self.enabled:
+            return
+        entry = {key: entry[key] for key in ('message', 'id') if key in entry}
+        data = get_binary_codec().dumps(entry)
+        if self.max_bytes > 0 and len(data) > self.max_bytes:
+            logger.debug("Not retaining %d byte message on tag '%s'", len(data), tag)
+            return
+        await self._set(tag, entry, data)
+
+    async def matching(self, subscriptions):
+        """
+        Returns {tag: entry} of the retained messages on the subscribed tags
+        and on every tag matched by a subscribed wildcard pattern.
+        """
+        if not self.enabled:
+            return {}
+        exact = [tag for tag in subscriptions if not is_pattern(tag)]
+        patterns = [tag for tag in subscriptions if is_pattern(tag)]
+        found = await self._get(exact) if exact else {}
+        if patterns:
+            # '#' alone matches every tag; the other patterns are checked
+            # against the tags under their literal prefix. Patterns starting
+            # with '+' have none, which reads the whole tag index: at most
+            # about RETAINED_MAX_TAGS tags.
+            match_all = '#' in patterns
+            compiled = [matcher.compile(pattern) for pattern in patterns]
+            candidates = set()
+            for tag in await self._candidates(patterns):
+                if tag not in found and (match_all or any(pattern.match(tag) for pattern in compiled)):
+                    candidates.add(tag)
+            if candidates:
+                found.update(await self._get(list(candidates)))
+        return found
+
+
+class RedisRetainedStore(BaseRetainedStore):
+    """
+    Keeps retained messages in Redis, shared by every worker, with an
+    optional in-process LRU in front for the exact tags looked up on connect.
+    """
+
+    def __init__(self, url, max_connections):
+        super().__init__()
+        from redis.asyncio import BlockingConnectionPool, Redis
+        self._redis = Redis(connection_pool=BlockingConnectionPool.from_url(url, max_connections=max_connections))
+        self._set_script = self._redis.register_script(SET_SCRIPT)
+        self._get_script = self._redis.register_script(GET_SCRIPT)
+        self._cache = RetainedCache(get_setting('RETAINED_CACHE_TTL'), get_setting('RETAINED_CACHE_SIZE'))
+
+    async def _set(self, tag, entry, data):
+        await self._set_script(
+            keys=[MESSAGES_KEY, UPDATED_KEY, TAGS_KEY],
+            args=[tag, data, self.ttl, self.max_tags, PRUNE_BATCH_SIZE],
+        )
+        self._cache.set(tag, entry)
+
+    async def _get(self, tags):
+        found = {}
+        missed = []
+        for tag in tags:
+            entry = self._cache.get(tag)
+            if entry is None:
+                missed.append(tag)
+            elif entry is not MISSING:
+                found[tag] = entry
+        if not missed:
+            return found
+
+        values = await self._get_script(keys=[MESSAGES_KEY, UPDATED_KEY], args=[self.ttl, *missed])
+        loads = get_binary_codec().loads
+        for tag, value in zip(missed, values):
+            entry = loads(value) if value else None
+            self._cache.set(tag, entry if entry is not None else MISSING)
+            if entry is not None:
+                found[tag] = entry
+        return found
+
+    async def _candidates(self, patterns):
+        # Tags matching a pattern are its literal prefix itself or start
+        # with it and a level separator ('0' sorts right after '/').
+        # A pattern without one needs every tag, which covers the others.
+        prefixes = {literal_prefix(pattern) for pattern in patterns}
+        async with self._redis.pipeline(transaction=False) as pipe:
+            if '' in prefixes:
+                pipe.zrangebylex(TAGS_KEY, "-", "+")
+            else:
+                for prefix in prefixes:
+                    pipe.zrangebylex(TAGS_KEY, f"[{prefix}", f"[{prefix}")
+                    pipe.zrangebylex(TAGS_KEY, f"[{prefix}/", f"({prefix}0")
+            results = await pipe.execute()
+        return {
+            tag.decode() if isinstance(tag, bytes) else tag
+            for tags in results for tag in tags
+        }
+
+
+class LocalRetainedStore(BaseRetainedStore):
+    """
+    In-process counterpart of RedisRetainedStore for single-worker setups.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._messages = OrderedDict()  # tag -> (retained at, entry), oldest first
+
+    def _live(self, tag):
+        item = self._messages.get(tag)
+        if item is None:
+            return None
+        retained_at, entry = item
+        if self.ttl > 0 and retained_at <= time.monotonic() - self.ttl:
+            del self._messages[tag]
+            return None
+        return entry
+
+    async def _set(self, tag, entry, data):
+        self._messages[tag] = (time.monotonic(), entry)
+        self._messages.move_to_end(tag)
+        while len(self._messages) > self.max_tags:
+            self._messages.popitem(last=False)
+
+    async def _get(self, tags):
+        found = {}
+        for tag in tags:
+            entry = self._live(tag)
+            if entry is not None:
+                found[tag] = entry
+        return found
+
+    async def _candidates(self, patterns):
+        prefixes = [literal_prefix(pattern) for pattern in patterns]
+        if '' in prefixes:
+            return list(self._messages)
+        return [
+            tag for tag in self._messages
+            if any(tag == prefix or tag.startswith(prefix + '/') for prefix in prefixes)
+        ]
+
+
+class RetainedCache:
+    """
+    A per-process LRU of tag -> retained entry (or MISSING) with a short
+    time-to-live, so bursts of connections to the same tags read Redis once.
+
+    Only writes of this worker update it: for up to its time-to-live, a
+    message retained through another worker is not seen here, or an older
+    one is sent in its place.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, tag):
+        """
+        Returns the cached entry (possibly MISSING), or None on a cache miss.
+        """
+        item = self._entries.get(tag)
+        if item is None:
+            return None
+        expires_at, entry = item
+        if expires_at < time.monotonic():
+            del self._entries[tag]
+            return None
+        self._entries.move_to_end(tag)
+        return entry
+
+    def set(self, tag, entry):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        self._entries[tag] = (time.monotonic() + self.ttl, entry)
+        self._entries.move_to_end(tag)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+_store = None
+
+
+def get_retained_store():
+    global _store
+    if _store is None:
+        url = get_setting('REDIS_URL')
+        if url:
+            _store = RedisRetainedStore(url, get_setting('REDIS_MAX_CONNECTIONS'))
+        else:
+            _store = LocalRetainedStore()
+    return _store
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+
+from brocker.conf import get_setting
+from brocker.worker_channel import worker_channel
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "routes:"
+# Sorted set of the route groups some worker has joined, scored by the
+# expiry of the last refresh by a worker holding them.
+GROUPS_KEY = f"{KEY_PREFIX}groups"
+# Control group of every worker, to learn about newly joined route groups
+# without waiting for the next refresh.
+ANNOUNCE_GROUP = "brocker.routes"
+ANNOUNCE_TYPE = "routes.announce"
+
+# Register route groups joined by a worker.
+# KEYS = groups; ARGV = ttl, then the groups.
+ADD_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+for i = 2, #ARGV do
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[1]), ARGV[i])
+end
+return #ARGV - 1
+"""
+
+# Refresh the route groups of a worker, drop those nobody refreshed in time
+# and return every live one.
+# KEYS = groups; ARGV = ttl, then the groups of the worker.
+REFRESH_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+for i = 2, #ARGV do
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[1]), ARGV[i])
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+return redis.call('ZRANGE', KEYS[1], 0, -1)
+"""
+
+
+class BaseRouteRegistry:
+    """
+    Tracks the route groups that wildcard subscribers joined on any worker,
+    so that a publish skips the route groups of prefixes nobody subscribes
+    under instead of sending to one route group per level of its tag.
+
+    This base class knows nothing about other workers and reports every
+    route group as active.
+    """
+
+    def __init__(self):
+        self._groups = set()  # route groups joined by this worker
+
+    def is_active(self, group):
+        return True
+
+    async def start(self):
+        pass
+
+    async def add(self, group):
+        """
+        Register a route group this worker joined, after joining it.
+        """
+        self._groups.add(group)
+        await self._add(group)
+
+    async def discard(self, group):
+        """
+        Forget a route group this worker left.
+        """
+        self._groups.discard(group)
+
+    async def _add(self, group):
+        pass
+
+
+class RedisRouteRegistry(BaseRouteRegistry):
+    """
+    Keeps the route groups of every worker in Redis as leases refreshed
+    every ROUTE_TTL / 3 seconds. Each worker loads them on start, reloads
+    them on every refresh and learns about newly joined ones at once from
+    an announcement on the channel layer.
+
+    A route group stays registered up to ROUTE_TTL seconds after its last
+    worker left it or died; meanwhile it is only sent to needlessly.
+    """
+
+    def __init__(self, url, max_connections):
+        super().__init__()
+        from redis.asyncio import BlockingConnectionPool, Redis
+        self.ttl = get_setting('ROUTE_TTL')
+        self._redis = Redis(connection_pool=BlockingConnectionPool.from_url(url, max_connections=max_connections))
+        self._add_script = self._redis.register_script(ADD_SCRIPT)
+        self._refresh_script = self._redis.register_script(REFRESH_SCRIPT)
+        self._active = None  # every live route group, None until loaded
+        self._announced_groups = None  # groups announced during a reload
+        self._loop = None
+        self._ready = None
+        self._refresh_task = None
+        worker_channel.register(ANNOUNCE_TYPE, self._announced)
+
+    def is_active(self, group):
+        # Until the groups are loaded, every route group may have members.
+        return self._active is None or group in self._active
+
+    async def start(self):
+        """
+        Load the live route groups and listen for new ones on the running
+        event loop. Cheap once started.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            await self._ready.wait()
+            return
+
+        self._loop = loop
+        self._ready = asyncio.Event()
+        self._active = None
+        self._refresh_task = loop.create_task(self._refresh_forever())
+        try:
+            await worker_channel.group_add(ANNOUNCE_GROUP)
+            await self._refresh()
+        except Exception:
+            logger.exception("Failed to load route groups; publishing to every route group")
+        finally:
+            self._ready.set()
+
+    def _activate(self, group):
+        if self._active is not None:
+            self._active.add(group)
+        if self._announced_groups is not None:
+            self._announced_groups.add(group)
+
+    async def _add(self, group):
+        await self.start()
+        self._activate(group)
+        # Registered before it is announced, so that a worker reloading the
+        # groups meanwhile cannot miss it.
+        try:
+            await self._add_script(keys=[GROUPS_KEY], args=[self.ttl, group])
+        except Exception:
+            logger.exception("Failed to register route group %s", group)
+        await get_channel_layer().group_send(ANNOUNCE_GROUP, {"type": ANNOUNCE_TYPE, "group": group})
+
+    async def _announced(self, event):
+        self._activate(event["group"])
+
+    async def _refresh(self):
+        # A group announced while the reload is on its way may be missing
+        # from the result; keep it.
+        self._announced_groups = set()
+        try:
+            groups = await self._refresh_script(keys=[GROUPS_KEY], args=[self.ttl, *self._groups])
+            self._active = {
+                group.decode() if isinstance(group, bytes) else group
+                for group in groups
+            } | self._announced_groups
+        finally:
+            self._announced_groups = None
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self._refresh()
+            except Exception:
+                logger.exception("Failed to refresh %d route groups", len(self._groups))
+
+
+class LocalRouteRegistry(BaseRouteRegistry):
+    """
+    In-process counterpart of RedisRouteRegistry for the in-memory channel
+    layer, where the route groups of this worker are all there are.
+    """
+
+    def is_active(self, group):
+        return group in self._groups
+
+
+_registry = None
+
+
+def get_route_registry():
+    global _registry
+    if _registry is None:
+        url = get_setting('REDIS_URL')
+        if url:
+            _registry = RedisRouteRegistry(url, get_setting('REDIS_MAX_CONNECTIONS'))
+        elif isinstance(get_channel_layer(), InMemoryChannelLayer):
+            _registry = LocalRouteRegistry()
+        else:
+            # Workers share a channel layer but not a registry.
+            _registry = BaseRouteRegistry()
+    return _registry
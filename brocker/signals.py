@@ -1,29 +1,57 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from brocker.models import BrokerPermission, BrokerTokens, BrokerTags
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from brocker.consumers import sanitize_tag
+from brocker.notifications import record_broker_change, record_change, record_changes
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Changes are collected per transaction and sent on commit, one message per
+# token; see brocker.notifications.
+
+def tokens_with_tag(tag):
+    """
+    Tokens holding a permission on the tag.
+    """
+    return list(
+        BrokerPermission.objects.filter(tag=tag)
+        .values_list('broker__token', flat=True)
+        .distinct()
+    )
+
+def permission_change(instance, permission_level):
+    return {
+        "type": "permission_update",
+        "tag_id": instance.tag_id,
+        "pattern": instance.tag.prefix,
+        "permission": permission_level
+    }
+
 def notify_permission_change(instance, permission_level):
-    channel_layer = get_channel_layer()
-    if channel_layer:
-        token = instance.broker.token
-        pattern = instance.tag.prefix
-        async_to_sync(channel_layer.group_send)(
-            f"token_{sanitize_tag(token)}",
-            {
-                "type": "permission_update",
-                "pattern": pattern,
-                "permission": permission_level
-            }
-        )
+    record_change([instance.broker.token], permission_change(instance, permission_level))
+
+def notify_permission_moved(instance):
+    logger.info(
+        "Permission moved from token id %s to '%s' on tag '%s'. Notifying clients.",
+        instance._old_broker_id, instance.broker.token, instance.tag.prefix
+    )
+    # The previous holder is matched by tag id; the pattern is not needed.
+    revoked = {"type": "permission_update", "tag_id": instance._old_tag_id, "pattern": None, "permission": None}
+    granted = permission_change(instance, instance.permission)
+    if instance._old_broker_id == instance.broker_id:
+        # Both changes in a single message.
+        record_changes([([instance.broker.token], revoked), ([instance.broker.token], granted)])
+    else:
+        # The previous token is looked up by id on commit, so that the save
+        # itself reads nothing more.
+        record_broker_change([instance._old_broker_id], revoked)
+        record_change([instance.broker.token], granted)
 
 @receiver(post_save, sender=BrokerPermission)
 def permission_updated(sender, instance, created, **kwargs):
+    if not created and (instance._old_broker_id, instance._old_tag_id) != (instance.broker_id, instance.tag_id):
+        notify_permission_moved(instance)
+        return
     action = "created" if created else "updated"
     logger.info(
         "Permission %s for token '%s' on tag '%s' with level '%s'. Notifying clients.",
@@ -39,42 +67,39 @@ def permission_deleted(sender, instance, **kwargs):
     )
     notify_permission_change(instance, None)
 
-def notify_token_change(token):
-    channel_layer = get_channel_layer()
-    if channel_layer:
-        logger.info("Notifying clients of token '%s' to disconnect due to modification/deletion.", token)
-        async_to_sync(channel_layer.group_send)(
-            f"token_{sanitize_tag(token)}",  
-            {"type": "token_update"}
-        )
+def notify_token_change(tokens):
+    logger.info("Notifying clients of tokens %s to disconnect due to modification/deletion.", tokens)
+    record_change(tokens, {"type": "token_update"})
 
 @receiver(post_delete, sender=BrokerTokens)
 def token_deleted(sender, instance, **kwargs):
-    notify_token_change(instance.token)
+    notify_token_change([instance.token])
 
 @receiver(post_save, sender=BrokerTokens)
 def token_updated(sender, instance, **kwargs):
-    notify_token_change(instance.token)
+    notify_token_change({instance.token, instance._old_token} - {None})
+
+def notify_tag_change(tag_id, old_prefix, prefix, tokens):
+    logger.info(
+        "Notifying %d tokens holding tag pattern '%s' of its modification.",
+        len(tokens), old_prefix
+    )
+    record_change(
+        tokens,
+        {"type": "tag_update", "tag_id": tag_id, "old_prefix": old_prefix, "prefix": prefix}
+    )
 
-def notify_tag_change(old_prefix):
-    channel_layer = get_channel_layer()
-    if channel_layer:
-        logger.info("Broadcasting tag pattern modification for '%s' to all clients.", old_prefix)
-        for broker in BrokerTokens.objects.all():
-            async_to_sync(channel_layer.group_send)(
-                f"token_{sanitize_tag(broker.token)}",
-                {
-                    "type": "tag_update",
-                    "old_prefix": old_prefix
-                }
-            )
+@receiver(pre_delete, sender=BrokerTags)
+def tag_deleting(sender, instance, **kwargs):
+    # The permissions on the tag are gone by post_delete.
+    instance._affected_tokens = tokens_with_tag(instance)
 
 @receiver(post_delete, sender=BrokerTags)
 def tag_deleted(sender, instance, **kwargs):
-    notify_tag_change(instance.prefix)
+    notify_tag_change(instance.id, instance.prefix, None, getattr(instance, '_affected_tokens', []))
 
 @receiver(post_save, sender=BrokerTags)
 def tag_updated(sender, instance, created, **kwargs):
     if not created and instance._old_prefix != instance.prefix:
         logger.info("Tag pattern updated from '%s' to '%s'.", instance._old_prefix, instance.prefix)
-        notify_tag_change(instance._old_prefix)
+        notify_tag_change(instance.id, instance._old_prefix, instance.prefix, tokens_with_tag(instance))
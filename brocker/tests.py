@@ -1,3 +1,891 @@
-from django.test import TestCase
+import asyncio
+import collections
+import json
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from brocker.MqttPatternMatcher import MqttPatternMatcher
+from brocker.models import BrokerPermission, BrokerTags, BrokerTokens
+from brocker import notifications
+from brocker.codecs import CODECS, frame_for, get_binary_codec
+from brocker.consumers import BrokerConsumer, publish_groups, route_group, tag_group
+from brocker.fanout import FANOUT_TYPE, LocalFanout
+from brocker.outbound import (
+    CONFLATE, DISCONNECT, DROP_NEWEST, DROP_OLDEST, SLOW_CONSUMER_CLOSE_CODE, OutboundQueue,
+)
+from brocker.permission_cache import MISSING, PermissionCache, TokenPermissions
+from brocker.provisioning import ProvisioningError, provision
+from brocker.replay import LocalReplayBuffer, parse_last_id
+from brocker.retained import LocalRetainedStore
+from brocker.routes import LocalRouteRegistry
+from brocker.topic_tree import PrefixIndex, TopicTree, literal_prefix, pattern_covers, patterns_overlap
+
+
+def _entry(name='device'):
+    return TokenPermissions(name, 0, None)
+
+
+class PermissionCacheTests(SimpleTestCase):
+
+    def test_unknown_tokens_do_not_evict_valid_ones(self):
+        cache = PermissionCache(ttl=60, max_size=2, missing_size=2)
+        cache.set('a', _entry('a'))
+        cache.set('b', _entry('b'))
+        for i in range(10):
+            cache.set(f'random{i}', MISSING)
+
+        self.assertEqual(cache.get('a').name, 'a')
+        self.assertEqual(cache.get('b').name, 'b')
+        self.assertIs(cache.get('random9'), MISSING)
+        self.assertIsNone(cache.get('random0'))
+
+    def test_token_moves_between_valid_and_missing(self):
+        cache = PermissionCache(ttl=60, max_size=2, missing_size=2)
+        cache.set('a', MISSING)
+        cache.set('a', _entry())
+        self.assertEqual(cache.get('a').name, 'device')
+        cache.set('a', MISSING)
+        self.assertIs(cache.get('a'), MISSING)
+
+    def test_invalidate_drops_missing_entries(self):
+        cache = PermissionCache(ttl=60, max_size=2, missing_size=2)
+        cache.set('a', MISSING)
+        cache.set('b', MISSING)
+        cache.invalidate(['a'])
+        self.assertIsNone(cache.get('a'))
+        self.assertIs(cache.get('b'), MISSING)
+        cache.invalidate()
+        self.assertIsNone(cache.get('b'))
+
+    def test_stale_generation_is_not_stored(self):
+        cache = PermissionCache(ttl=60, max_size=2, missing_size=2)
+        generation = cache.generation
+        cache.invalidate(['a'])
+        cache.set('a', _entry(), generation)
+        self.assertIsNone(cache.get('a'))
+
+    def test_revision_load_survives_only_its_own_invalidation(self):
+        cache = PermissionCache(ttl=60, max_size=2, missing_size=2)
+        generation = cache.generation
+        cache.invalidate(['a'], revision='r1')
+        cache.set('a', _entry(), generation, revision='r1')
+        self.assertEqual(cache.get('a').name, 'device')
+
+        generation = cache.generation
+        cache.invalidate(['a'], revision='r1')
+        cache.invalidate(['a'], revision='r2')
+        cache.set('a', _entry('stale'), generation, revision='r1')
+        self.assertIsNone(cache.get('a'))
+
+
+class FrameTests(SimpleTestCase):
+
+    def test_frames_are_encoded_once_per_format(self):
+        entry = {"message": {"value": 1}, "id": 7}
+        with mock.patch.object(type(get_binary_codec()), 'encode_frame', autospec=True,
+                               side_effect=lambda codec, tag, message, id=None: b'frame') as encode:
+            self.assertEqual(frame_for(entry, 'a/b', 'bytes'), b'frame')
+            self.assertEqual(frame_for(entry, 'a/b', 'bytes'), b'frame')
+        encode.assert_called_once()
+        self.assertNotIn('text', entry)
+
+    def test_bytes_have_no_json_frame_with_any_codec(self):
+        for name, codec_class in CODECS.items():
+            with self.subTest(codec=name):
+                try:
+                    codec = codec_class()
+                except ImportError:
+                    continue
+                with mock.patch('brocker.codecs.get_codec', return_value=codec):
+                    entry = {"message": {"raw": [b'\x00']}}
+                    self.assertIsNone(frame_for(entry, 'a/b', 'text'))
+                    self.assertIsNotNone(frame_for(entry, 'a/b', 'bytes'))
+
+
+    def test_bytes_in_container_subclasses_have_no_json_frame(self):
+        import msgpack
+        Reading = collections.namedtuple('Reading', ['raw'])
+        for message in (
+            Reading(b'\x00'),
+            msgpack.ExtType(1, b'\x00'),
+            collections.OrderedDict(raw=b'\x00'),
+            {"readings": [Reading(bytearray(b'\x00'))]},
+        ):
+            for name, codec_class in CODECS.items():
+                with self.subTest(codec=name, message=message):
+                    try:
+                        codec = codec_class()
+                    except ImportError:
+                        continue
+                    with mock.patch('brocker.codecs.get_codec', return_value=codec):
+                        self.assertIsNone(frame_for({"message": message}, 'a/b', 'text'))
+
+class OutboundQueueTests(SimpleTestCase):
+
+    def _queue(self, policy, maxsize=2):
+        self.sent = []
+        self.closed = []
+        self.release = asyncio.Event()
+
+        async def send(text_data=None, bytes_data=None):
+            await self.release.wait()
+            self.sent.append(text_data)
+
+        async def close(code=None):
+            self.closed.append(code)
+
+        return OutboundQueue(send, close, maxsize=maxsize, policy=policy)
+
+    async def _fill(self, queue, frames):
+        # The writer takes the first frame and blocks sending it.
+        queue.put('t', 'first')
+        await asyncio.sleep(0)
+        for tag, frame in frames:
+            queue.put(tag, frame)
+
+    async def _drain(self, queue):
+        self.release.set()
+        await queue.join()
+        queue.close()
+        return self.sent[1:]
+
+    async def test_drop_oldest(self):
+        queue = self._queue(DROP_OLDEST)
+        await self._fill(queue, [('t', 1), ('t', 2), ('t', 3)])
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(await self._drain(queue), [2, 3])
+
+    async def test_drop_newest(self):
+        queue = self._queue(DROP_NEWEST)
+        await self._fill(queue, [('t', 1), ('t', 2), ('t', 3)])
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(await self._drain(queue), [1, 2])
+
+    async def test_conflate_replaces_without_counting_a_drop(self):
+        queue = self._queue(CONFLATE)
+        await self._fill(queue, [('a', 1), ('a', 2), ('b', 3)])
+        self.assertEqual(queue.dropped, 0)
+        queue.put('c', 4)
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(await self._drain(queue), [3, 4])
+
+    async def test_disconnect(self):
+        queue = self._queue(DISCONNECT)
+        await self._fill(queue, [('t', 1), ('t', 2), ('t', 3)])
+        await queue._close_task
+        self.assertEqual(self.closed, [SLOW_CONSUMER_CLOSE_CODE])
+        self.assertEqual(queue.dropped, 3)
+        queue.put('t', 4)
+        self.assertEqual(len(queue), 0)
+        queue.close()
+
+    async def test_join_waits_for_queued_frames(self):
+        queue = self._queue(DROP_OLDEST, maxsize=10)
+        await self._fill(queue, [('t', 1), ('t', 2)])
+        join = asyncio.ensure_future(queue.join())
+        await asyncio.sleep(0)
+        self.assertFalse(join.done())
+        self.release.set()
+        await join
+        self.assertEqual(self.sent, ['first', 1, 2])
+        queue.close()
+
+
+class PatternTests(SimpleTestCase):
+
+    def test_literal_prefix_stops_only_at_wildcards(self):
+        self.assertEqual(literal_prefix('site.a/+/temp'), 'site.a')
+        self.assertEqual(literal_prefix('logs/(a|b)/#'), 'logs/(a|b)')
+        self.assertEqual(literal_prefix('sensor+/temp'), '')
+        self.assertEqual(literal_prefix('a/#/b'), 'a/#/b')
+        self.assertEqual(literal_prefix('#'), '')
+
+    def test_regex_characters_match_themselves(self):
+        for pattern, topic, expected in [
+            ('site.a/+/temp', 'site.a/1/temp', True),
+            ('site.a/+/temp', 'siteXa/1/temp', False),
+            ('logs/(a|b)/#', 'logs/a', False),
+            ('logs/(a|b)/#', 'logs/(a|b)/x', True),
+            ('sensor+/temp', 'sensor12/temp', True),
+        ]:
+            with self.subTest(pattern=pattern, topic=topic):
+                self.assertEqual(bool(MqttPatternMatcher.compile(pattern).match(topic)), expected)
+                self.assertEqual(TopicTree([(pattern, True)]).match(topic) is not None, expected)
+
+    def test_wildcard_tags_must_be_covered_by_a_grant(self):
+        for grant, tag, expected in [
+            ('sensors/+', 'sensors/+', True),
+            ('sensors/#', 'sensors/+', True),
+            ('sensors/#', 'sensors/#', True),
+            ('sensors/#', 'sensors/a/#', True),
+            ('#', '#', True),
+            ('#', '+/x', True),
+            ('+/+', '+/x', True),
+            ('+/#', 'x/+/#', True),
+            ('sensor+/t', 'sensor+/t', True),
+            ('sensors/+', 'sensors/#', False),
+            ('+', '#', False),
+            ('+/#', '#', False),
+            ('sensors/a/#', 'sensors/#', False),
+            ('sensors/+/x', 'sensors/+', False),
+            ('sensors/+', 'sensors/+/x', False),
+            ('sensors/+', '+/x', False),
+            ('sensor+/t', '+/t', False),
+        ]:
+            with self.subTest(grant=grant, tag=tag):
+                self.assertEqual(pattern_covers(grant, tag), expected)
+                found = TopicTree([(grant, True)]).match_pattern(tag)
+                self.assertEqual(found is not None, expected)
+
+    def test_most_specific_covering_grant_wins(self):
+        index = TopicTree([('sensors/#', 'readwrite'), ('sensors/+', 'read'), ('+/+', 'none')])
+        self.assertEqual(index.match_pattern('sensors/+'), ('sensors/+', 'read'))
+        self.assertEqual(index.match_pattern('sensors/a/+'), ('sensors/#', 'readwrite'))
+        self.assertEqual(index.match_pattern('sensors/room1'), ('sensors/+', 'read'))
+        self.assertIsNone(index.match_pattern('#'))
+
+
+class TopicTreeTests(SimpleTestCase):
+
+    GRANTS = [
+        '#', 'sensors/#', 'sensors/+', 'sensors/+/temp', 'sensors/room1/temp', '+/+/temp',
+        'sensors', 'a//b', 'a/+/b', 'a/+', '+', 'sensor+/x', 'x/#', 'site.a/+',
+    ]
+    TOPICS = [
+        'sensors', 'sensors/room1', 'sensors/room1/temp', 'sensors/room2/temp', 'sensors/a/b/c',
+        'sensors/', 'a//b', 'a/x/b', 'a/', 'a', '/', '', 'sensor12/x', 'x', 'x/y/z',
+        'site.a/1', 'siteXa/1', 'b/c/temp', '/room1/temp',
+    ]
+
+    def _matching(self, grants, topic):
+        return {grant for grant in grants if MqttPatternMatcher.compile(grant).match(topic)}
+
+    def test_match_all_agrees_with_the_matcher(self):
+        tree = TopicTree([(grant, None) for grant in self.GRANTS])
+        for topic in self.TOPICS:
+            with self.subTest(topic=topic):
+                expected = self._matching(self.GRANTS, topic)
+                self.assertEqual({pattern for pattern, _ in tree.match_all(topic)}, expected)
+                found = tree.match(topic)
+                self.assertEqual(found is not None, bool(expected))
+                if found is not None:
+                    self.assertIn(found[0], expected)
+
+    def test_matched_by_agrees_with_the_matcher(self):
+        entries = {*self.GRANTS, *self.TOPICS, 'a/#/b', '#/x', 'x/+/#'}
+        tree = TopicTree([(entry, None) for entry in entries])
+        for pattern in self.GRANTS + ['+/#', '#/#', 'sensors/+/#', 'x/+/+', '+/x', 'sensor+/+']:
+            with self.subTest(pattern=pattern):
+                regex = MqttPatternMatcher.compile(pattern)
+                found = [entry for entry, _ in tree.matched_by(pattern)]
+                self.assertEqual(sorted(found), sorted(entry for entry in entries if regex.match(entry)))
+
+    def test_removed_patterns_stop_matching(self):
+        tree = TopicTree([(grant, None) for grant in self.GRANTS])
+        kept = self.GRANTS[1::2]
+        for grant in self.GRANTS[::2]:
+            tree.remove(grant)
+        self.assertEqual(len(tree), len(kept))
+        for topic in self.TOPICS:
+            with self.subTest(topic=topic):
+                self.assertEqual({pattern for pattern, _ in tree.match_all(topic)}, self._matching(kept, topic))
+
+    def test_most_specific_match_wins(self):
+        tree = TopicTree([(grant, grant) for grant in self.GRANTS])
+        for topic, expected in [
+            ('sensors', 'sensors'),
+            ('sensors/room1', 'sensors/+'),
+            ('sensors/room1/temp', 'sensors/room1/temp'),
+            ('sensors/room2/temp', 'sensors/+/temp'),
+            ('sensors/a/b/c', 'sensors/#'),
+            ('sensors/', 'sensors/#'),
+            ('a//b', 'a//b'),
+            ('a/x/b', 'a/+/b'),
+            ('b/c/temp', '+/+/temp'),
+            ('/room1/temp', '#'),
+            ('sensor12/x', '#'),
+        ]:
+            with self.subTest(topic=topic):
+                self.assertEqual(tree.match(topic), (expected, expected))
+
+    def test_match_pattern_finds_the_most_specific_covering_grant(self):
+        tree = TopicTree([(grant, grant) for grant in self.GRANTS])
+        for tag, expected in [
+            ('sensors/+', 'sensors/+'),
+            ('sensors/+/temp', 'sensors/+/temp'),
+            ('sensors/room1/+', 'sensors/#'),
+            ('sensors/#', 'sensors/#'),
+            ('+/room1/temp', '+/+/temp'),
+            ('a/+/b', 'a/+/b'),
+            ('x/+/#', 'x/#'),
+            ('+', '+'),
+            ('#', '#'),
+        ]:
+            with self.subTest(tag=tag):
+                covering = [grant for grant in self.GRANTS if pattern_covers(grant, tag)]
+                # A covering grant matches the requested pattern read as a topic.
+                self.assertTrue(covering)
+                self.assertEqual(set(covering) - self._matching(self.GRANTS, tag), set())
+                self.assertEqual(tree.match_pattern(tag), (expected, expected))
+
+    def test_match_pattern_needs_a_covering_grant(self):
+        tree = TopicTree([(grant, None) for grant in ['sensors/+', 'a/+', 'sensor+/x']])
+        for tag in ['sensors/#', 'sensors/+/temp', '+/x', '+', '#', 'a/#']:
+            with self.subTest(tag=tag):
+                self.assertIsNone(tree.match_pattern(tag))
+
+    def test_prefix_index_agrees_with_the_matcher(self):
+        indexed = ['sensors/a', '+/temp/x', 'site.a/#', 'alerts/+/high', 'a//b', 'logs/(a|b)', 'sensor+/y']
+        index = PrefixIndex(indexed)
+        for pattern in [
+            'sensors/+', 'sensors/b', 'a/temp/x', 'site.a', 'site.b/#', 'alerts/x/high', '#', '+',
+            'a/+/b', 'a/', 'logs/+', 'logs/a', 'sensor1/y', '+/y', '',
+        ]:
+            with self.subTest(pattern=pattern):
+                overlapping = {
+                    other for other in indexed
+                    if MqttPatternMatcher.compile(pattern).match(other)
+                    or MqttPatternMatcher.compile(other).match(pattern)
+                }
+                found = index.find_overlap(pattern)
+                self.assertEqual(found is not None, bool(overlapping))
+                if found is not None:
+                    self.assertIn(found, overlapping)
+
+
+class _Subscriber:
+
+    def __init__(self, channel_name='sub'):
+        self.channel_name = channel_name
+        self.events = []
+
+    def deliver(self, event):
+        self.events.append(event)
+
+
+class LocalFanoutTests(SimpleTestCase):
+
+    def setUp(self):
+        self.joins = {}
+        patcher = mock.patch('brocker.fanout.worker_channel')
+        self.worker_channel = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.worker_channel.group_add = self._join
+        self.worker_channel.group_discard = mock.AsyncMock()
+
+    async def _join(self, group):
+        # Joins complete only when the test sets their event.
+        await self.joins.setdefault(group, asyncio.Event()).wait()
+
+    def _event(self, publish_id, tag='a/b'):
+        return {"type": FANOUT_TYPE, "tag": tag, "channel": "pub", "publish_id": publish_id}
+
+    async def test_copies_of_one_publish_are_delivered_once(self):
+        fanout = LocalFanout()
+        subscriber = _Subscriber()
+        self.joins['tag'] = self.joins['route'] = asyncio.Event()
+        self.joins['tag'].set()
+        await fanout.subscribe('tag', 'a/b', subscriber)
+        await fanout.subscribe('route', 'a/+', subscriber)
+
+        for _ in range(2):
+            await fanout.dispatch(self._event('p:1'))
+        await fanout.dispatch(self._event('p:2'))
+        self.assertEqual([event["publish_id"] for event in subscriber.events], ['p:1', 'p:2'])
+
+    async def test_copies_around_an_inflight_join_are_delivered_once(self):
+        fanout = LocalFanout()
+        subscriber = _Subscriber()
+        self.joins['route'] = asyncio.Event()
+        self.joins['route'].set()
+        await fanout.subscribe('route', 'a/+', subscriber)
+
+        # The tag group join is in flight: one copy arrives before it
+        # completes and one after.
+        join = asyncio.ensure_future(fanout.subscribe('tag', 'a/b', subscriber))
+        await asyncio.sleep(0)
+        await fanout.dispatch(self._event('p:1'))
+        self.joins['tag'].set()
+        await join
+        await fanout.dispatch(self._event('p:1'))
+        self.assertEqual(len(subscriber.events), 1)
+
+    async def test_subscribe_during_last_leave_rejoins(self):
+        fanout = LocalFanout()
+        first, second = _Subscriber('one'), _Subscriber('two')
+        self.joins['tag'] = asyncio.Event()
+        self.joins['tag'].set()
+        await fanout.subscribe('tag', 'a/b', first)
+
+        left = asyncio.Event()
+
+        async def discard(group):
+            await left.wait()
+        self.worker_channel.group_discard = discard
+        leave = asyncio.ensure_future(fanout.unsubscribe('tag', 'a/b', first))
+        await asyncio.sleep(0)
+        join = asyncio.ensure_future(fanout.subscribe('tag', 'a/b', second))
+        await asyncio.sleep(0)
+        left.set()
+        await asyncio.gather(leave, join)
+        self.assertIn('tag', fanout._joined)
+        self.assertEqual(fanout.subscribers('a/b'), {second})
+
+    async def test_own_messages_are_not_echoed(self):
+        fanout = LocalFanout()
+        publisher = _Subscriber('pub')
+        self.joins['tag'] = asyncio.Event()
+        self.joins['tag'].set()
+        await fanout.subscribe('tag', 'a/b', publisher)
+        await fanout.dispatch(self._event('p:1'))
+        self.assertEqual(publisher.events, [])
+
+
+class PublishGroupsTests(SimpleTestCase):
+
+    async def test_route_groups_without_subscribers_are_skipped(self):
+        routes = LocalRouteRegistry()
+        self.assertEqual(publish_groups('site.a/r/temp', routes), [tag_group('site.a/r/temp')])
+
+        await routes.add(route_group('site.a'))
+        self.assertEqual(
+            publish_groups('site.a/r/temp', routes),
+            [tag_group('site.a/r/temp'), route_group('site.a')],
+        )
+        await routes.discard(route_group('site.a'))
+        self.assertEqual(publish_groups('site.a/r/temp', routes), [tag_group('site.a/r/temp')])
+
+
+
+class RetainedStoreTests(SimpleTestCase):
+
+    async def test_patterns_without_literal_prefix(self):
+        store = LocalRetainedStore()
+        for tag in ('a/status', 'b/status', 'b/config'):
+            await store.set(tag, {"message": tag, "id": None})
+
+        self.assertEqual(set(await store.matching(['+/status'])), {'a/status', 'b/status'})
+        self.assertEqual(set(await store.matching(['#', 'a/+'])), {'a/status', 'b/status', 'b/config'})
+
+
+async def _replay(buffer, subscriptions, last_id):
+    return [(tag, entries) async for tag, entries in buffer.replay(subscriptions, last_id)]
+
+
+class ReplayBufferTests(SimpleTestCase):
+
+    async def _buffer(self):
+        buffer = LocalReplayBuffer()
+        buffer.batch_size = 2
+        await buffer.append('t/b', ['b1'])
+        await buffer.append('t/a', ['a2', 'a3'])
+        await buffer.append('t/b', ['b4'])
+        await buffer.append('t/a', ['a5'])
+        return buffer
+
+    async def test_tags_are_replayed_in_id_order(self):
+        buffer = await self._buffer()
+        self.assertEqual(await _replay(buffer, ['t/#'], 1), [
+            ('t/a', [(2, 'a2'), (3, 'a3')]),
+            ('t/b', [(4, 'b4')]),
+            ('t/a', [(5, 'a5')]),
+        ])
+        self.assertEqual(await _replay(buffer, ['t/#'], 4), [('t/a', [(5, 'a5')])])
+
+    async def test_limit_stops_in_id_order(self):
+        buffer = await self._buffer()
+        buffer.max_messages = 3
+        runs = await _replay(buffer, ['t/#'], 0)
+        self.assertEqual([entry for _, entries in runs for entry in entries], [(1, 'b1'), (2, 'a2'), (3, 'a3')])
+
+    async def test_buffers_expire(self):
+        buffer = LocalReplayBuffer()
+        buffer.ttl = 60
+        with mock.patch('brocker.replay.time.monotonic', return_value=1000):
+            await buffer.append('t/a', ['a1'])
+        with mock.patch('brocker.replay.time.monotonic', return_value=1059):
+            self.assertEqual(await _replay(buffer, ['t/+'], 0), [('t/a', [(1, 'a1')])])
+        with mock.patch('brocker.replay.time.monotonic', return_value=1060):
+            self.assertEqual(await _replay(buffer, ['t/+'], 0), [])
+
+    def test_parse_last_id(self):
+        self.assertEqual(parse_last_id('18234'), 18234)
+        self.assertEqual(parse_last_id('0'), 0)
+        for value in (None, '', '-1', '1.5', 'abc'):
+            self.assertIsNone(parse_last_id(value))
+
+
+class CatchUpTests(SimpleTestCase):
+
+    def setUp(self):
+        self.buffer = LocalReplayBuffer()
+        self.retained = LocalRetainedStore()
+        for name, backend in (('get_replay_buffer', self.buffer), ('get_retained_store', self.retained)):
+            patcher = mock.patch(f'brocker.consumers.{name}', return_value=backend)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.sent = []
+        self.closed = []
+
+    def _consumer(self, last_id, maxsize=100):
+        async def send(text_data=None, bytes_data=None):
+            self.sent.append(json.loads(text_data))
+
+        async def close(code=None):
+            self.closed.append(code)
+
+        consumer = BrokerConsumer()
+        consumer.scope = {"tag_permissions": {'t/#': 'read'}, "last_id": last_id}
+        consumer.outbound = OutboundQueue(send, close, maxsize=maxsize, policy=DROP_OLDEST)
+        consumer.held_events = []
+        return consumer
+
+    async def _catch_up(self, consumer):
+        await consumer.catch_up()
+        await consumer.outbound.join()
+        consumer.outbound.close()
+        return [(frame['tag'], frame['message']) for frame in self.sent]
+
+    async def test_held_messages_follow_the_replay_once(self):
+        ids = await self.buffer.append('t/a', ['a1', 'a2'])
+        consumer = self._consumer(last_id=0)
+        consumer.deliver({"tag": 't/a', "message": 'a2', "id": ids[1]})
+        consumer.deliver({"tag": 't/b', "message": 'b', "id": ids[1] + 1})
+        self.assertEqual(await self._catch_up(consumer), [('t/a', 'a1'), ('t/a', 'a2'), ('t/b', 'b')])
+        self.assertIsNone(consumer.held_events)
+
+    async def test_retained_messages_missing_from_the_buffer_are_sent(self):
+        await self.buffer.append('t/a', ['a1', 'a2'])
+        await self.retained.set('t/a', {"message": 'a2', "id": 2})
+        await self.retained.set('t/old', {"message": 'seen', "id": 1})
+        await self.retained.set('t/expired', {"message": 'unseen', "id": 3})
+        consumer = self._consumer(last_id=1)
+        self.assertEqual(await self._catch_up(consumer), [('t/a', 'a2'), ('t/expired', 'unseen')])
+
+    async def test_too_many_held_messages_close_the_connection(self):
+        consumer = self._consumer(last_id=0, maxsize=2)
+        for i in range(3):
+            consumer.deliver({"tag": 't/a', "message": i})
+        await consumer.outbound._close_task
+        self.assertEqual(self.closed, [SLOW_CONSUMER_CLOSE_CODE])
+        self.assertEqual(await self._catch_up(consumer), [])
+
+
+class NotificationTests(TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.submitted = 0
+
+        async def send(channel_layer, tokens, revision, messages):
+            self.sent.append({token: message["changes"] for token, message in messages})
+
+        def submit():
+            self.submitted += 1
+        for name, value in (('_send', send), ('_submit', submit), ('_outbox', None)):
+            patcher = mock.patch.object(notifications, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _deliver(self):
+        for _ in range(self.submitted):
+            async_to_sync(notifications._deliver)()
+        self.submitted = 0
+
+    def test_changes_of_a_transaction_are_sent_once_per_token(self):
+        update = {"type": "token_update"}
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                notifications.record_change(['a', 'b'], update)
+                with transaction.atomic():
+                    notifications.record_change(['a'], update)
+        self._deliver()
+        self.assertEqual(self.sent, [{'a': [update], 'b': [update]}])
+
+    def test_one_callback_per_savepoint(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                for token in 'abc':
+                    notifications.record_change([token], {"type": "token_update"})
+                with transaction.atomic():
+                    notifications.record_change(['d'], {"type": "token_update"})
+                    notifications.record_change(['e'], {"type": "token_update"})
+                notifications.record_change(['f'], {"type": "token_update"})
+        self.assertEqual(len(callbacks), 2)
+
+    def test_sends_are_left_to_the_background(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                notifications.record_change(['a'], {"type": "token_update"})
+        self.assertEqual((self.sent, self.submitted), ([], 1))
+        self._deliver()
+        self.assertEqual(list(self.sent[0]), ['a'])
+
+    def test_changes_of_a_rolled_back_savepoint_are_dropped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                notifications.record_change(['a'], {"type": "token_update"})
+                with self.assertRaises(ValueError), transaction.atomic():
+                    notifications.record_change(['b'], {"type": "token_update"})
+                    raise ValueError
+                notifications.record_change(['c'], {"type": "token_update"})
+        self._deliver()
+        self.assertEqual(sorted(self.sent[0]), ['a', 'c'])
+
+    def test_moved_permission_is_saved_without_reading_the_previous_token(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            old = BrokerTokens.objects.create(token='old')
+            new = BrokerTokens.objects.create(token='new')
+            tag = BrokerTags.objects.create(prefix='sensors')
+            permission = BrokerPermission.objects.create(broker=old, tag=tag, permission='read')
+        self._deliver()
+        permission = BrokerPermission.objects.select_related('tag').get(pk=permission.pk)
+        self.sent.clear()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                permission.broker = new
+                with self.assertNumQueries(1):
+                    permission.save()
+        self._deliver()
+        revoked = {"type": "permission_update", "tag_id": tag.id, "pattern": None, "permission": None}
+        granted = {"type": "permission_update", "tag_id": tag.id, "pattern": 'sensors', "permission": 'read'}
+        self.assertEqual(self.sent, [{'new': [granted], 'old': [revoked]}])
+
+
+class BrokerTagsTests(TestCase):
+
+    EXISTING = ['sensors/a', '+/temp/x', 'site.a/#', 'alerts/+/high', 'x/y/z']
+
+    # (new prefix, existing prefix it overlaps or None)
+    CASES = [
+        ('sensors/+', 'sensors/a'),
+        ('sensors/b', None),
+        ('a/temp/x', '+/temp/x'),
+        ('b/temp/y', None),
+        ('site.a', 'site.a/#'),
+        ('site.a/b/c', 'site.a/#'),
+        ('site.b/c', None),
+        ('alerts/x/low', None),
+        ('x/+/z', 'x/y/z'),
+        ('x/y/#', 'x/y/z'),
+        ('x/y', None),
+        ('#', 'sensors/a'),
+    ]
+
+    def setUp(self):
+        for prefix in self.EXISTING:
+            BrokerTags.objects.create(prefix=prefix)
+
+    def test_clean_finds_every_overlap(self):
+        for prefix, conflict in self.CASES:
+            with self.subTest(prefix=prefix):
+                expected = [e for e in self.EXISTING if patterns_overlap(prefix, e)]
+                self.assertEqual(bool(expected), conflict is not None)
+                if conflict is None:
+                    BrokerTags(prefix=prefix).clean()
+                else:
+                    with self.assertRaisesMessage(ValidationError, 'overlaps'):
+                        BrokerTags(prefix=prefix).clean()
+
+    def test_clean_ignores_the_tag_itself(self):
+        tag = BrokerTags.objects.get(prefix='x/y/z')
+        tag.prefix = 'x/+/z'
+        tag.clean()
+
+    def test_bulk_create_validated(self):
+        tags = BrokerTags.objects.bulk_create_validated(['sensors/b', 'site.b/+/temp'])
+        self.assertEqual([tag.literal_prefix for tag in tags], ['sensors/b', 'site.b'])
+        self.assertEqual(
+            BrokerTags.objects.get(prefix='site.b/+/temp').literal_prefix, 'site.b',
+        )
+
+    def test_bulk_create_validated_creates_nothing_on_overlap(self):
+        for prefixes in (['b/c', 'sensors/+'], ['b/c', 'b/+']):
+            with self.subTest(prefixes=prefixes), self.assertRaises(ValidationError):
+                BrokerTags.objects.bulk_create_validated(prefixes)
+        self.assertFalse(BrokerTags.objects.filter(prefix='b/c').exists())
+
+
+class ProvisioningTests(TestCase):
+
+    def test_creates_tokens_tags_and_permissions(self):
+        result = provision([
+            {"token": 't1', "name": 'sensor', "max_connections": '2', "tag": 'sensors/+', "permission": 'readwrite'},
+            {"token": 't1', "tag": 'alerts'},
+        ])
+        self.assertEqual(result, (1, 0, 2, 2))
+        broker = BrokerTokens.objects.get(token='t1')
+        self.assertEqual((broker.name, broker.max_connections), ('sensor', 2))
+        self.assertEqual(
+            dict(broker.brokerpermission_set.values_list('tag__prefix', 'permission')),
+            {'sensors/+': 'readwrite', 'alerts': 'read'},
+        )
+
+    def test_updates_existing_rows_in_place(self):
+        broker = BrokerTokens.objects.create(token='t1', name='old')
+        tag = BrokerTags.objects.create(prefix='sensors')
+        permission = BrokerPermission.objects.create(broker=broker, tag=tag, permission='read')
+
+        result = provision(
+            [{"token": 't1', "name": 'new', "tag": 'sensors', "permission": 'readwrite'}], update_tokens=True,
+        )
+        self.assertEqual(result, (0, 1, 0, 1))
+        permission.refresh_from_db()
+        broker.refresh_from_db()
+        self.assertEqual((broker.name, permission.permission), ('new', 'readwrite'))
+        self.assertEqual(BrokerPermission.objects.count(), 1)
+
+    def test_unknown_permission_writes_nothing(self):
+        with self.assertRaisesMessage(ProvisioningError, "Record 2: invalid permission 'admin'"):
+            provision([{"token": 't1', "tag": 'a'}, {"token": 't2', "tag": 'b', "permission": 'admin'}])
+        self.assertFalse(BrokerTokens.objects.exists())
+
+    def test_invalid_records(self):
+        for record in (
+            {"token": 't5', "tag": ['x']},
+            {"token": 5},
+            {"token": 't5', "name": 7},
+            {"token": 't5', "tag": 'x', "permission": 1},
+            {"token": 't5', "max_connections": -3},
+            {"token": 't5', "max_connections": 'many'},
+            {"token": 't5', "max_connections": True},
+            {"name": 'no token'},
+        ):
+            with self.subTest(record=record), self.assertRaisesRegex(ProvisioningError, '^Record 1: '):
+                provision([record])
+        self.assertFalse(BrokerTokens.objects.exists())
+
+
+class ConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.retained = LocalRetainedStore()
+        self.buffer = LocalReplayBuffer()
+        for name, backend in (('get_replay_buffer', self.buffer), ('get_retained_store', self.retained)):
+            patcher = mock.patch(f'brocker.consumers.{name}', return_value=backend)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.communicators = []
+
+    async def _disconnect(self):
+        for communicator in self.communicators:
+            await communicator.disconnect()
+
+    def _grant(self, token, grants):
+        broker = BrokerTokens.objects.create(token=token)
+        for prefix, permission in grants:
+            tag = BrokerTags.objects.filter(prefix=prefix).first() or BrokerTags.objects.create(prefix=prefix)
+            BrokerPermission.objects.create(broker=broker, tag=tag, permission=permission)
+
+    async def _connect(self, token, tags, last_id=None):
+        from myproject.asgi import application
+        headers = [(b'authorization', f'Token {token}'.encode()), (b'tag', tags.encode())]
+        if last_id is not None:
+            headers.append((b'last-id', str(last_id).encode()))
+        communicator = WebsocketCommunicator(application, '/ws/brocker/', headers=headers)
+        connected, code = await communicator.connect()
+        if connected:
+            self.communicators.append(communicator)
+            # The tag groups are joined after the handshake.
+            await asyncio.sleep(0.05)
+        return communicator, connected, code
+
+    def _set_permission(self, token, prefix, permission):
+        granted = BrokerPermission.objects.get(broker__token=token, tag__prefix=prefix)
+        if permission is None:
+            granted.delete()
+        else:
+            granted.permission = permission
+            granted.save()
+
+    def _rename_tag(self, prefix, new_prefix):
+        tag = BrokerTags.objects.get(prefix=prefix)
+        tag.prefix = new_prefix
+        tag.save()
+
+    async def _received(self, communicator):
+        received = []
+        while not await communicator.receive_nothing(0.1):
+            received.append(json.loads(await communicator.receive_from()))
+        return [(frame['tag'], frame['message']) for frame in received]
+
+    async def _setup_sensors(self):
+        await sync_to_async(self._grant)('reader', [('sensors/+', 'read')])
+        await sync_to_async(self._grant)('writer', [('sensors/+', 'readwrite'), ('sensors/a/b', 'readwrite')])
+
+    async def test_narrower_grant_does_not_cover_wildcard_tags(self):
+        await self._setup_sensors()
+        for tags in ('sensors/#', '#', 'sensors/+/b', 'sensors/+,sensors/#'):
+            with self.subTest(tags=tags):
+                _, connected, code = await self._connect('reader', tags)
+                self.assertFalse(connected)
+                self.assertEqual(code, 4003)
+
+    async def test_wildcard_subscriber_only_receives_granted_tags(self):
+        await self._setup_sensors()
+        reader, connected, _ = await self._connect('reader', 'sensors/+')
+        self.assertTrue(connected)
+        writer, _, _ = await self._connect('writer', 'sensors/a,sensors/a/b')
+        await writer.send_to(text_data=json.dumps({"tag": 'sensors/a/b', "message": 'secret'}))
+        await writer.send_to(text_data=json.dumps({"tag": 'sensors/a', "message": 'public'}))
+        self.assertEqual(await self._received(reader), [('sensors/a', 'public')])
+        await self._disconnect()
+
+    async def test_retained_messages_outside_the_grant_are_not_sent(self):
+        await self._setup_sensors()
+        await self.retained.set('sensors/a', {"message": 'public'})
+        await self.retained.set('sensors/a/b', {"message": 'secret'})
+        _, connected, _ = await self._connect('reader', 'sensors/#')
+        self.assertFalse(connected)
+        reader, connected, _ = await self._connect('reader', 'sensors/+')
+        self.assertTrue(connected)
+        self.assertEqual(await self._received(reader), [('sensors/a', 'public')])
+        await self._disconnect()
+
+    async def test_catch_up_only_replays_granted_tags(self):
+        await self._setup_sensors()
+        await self.buffer.append('sensors/a/b', ['secret'])
+        await self.buffer.append('sensors/a', ['public'])
+        _, connected, _ = await self._connect('reader', 'sensors/#', last_id=0)
+        self.assertFalse(connected)
+        reader, connected, _ = await self._connect('reader', 'sensors/+', last_id=0)
+        self.assertTrue(connected)
+        self.assertEqual(await self._received(reader), [('sensors/a', 'public')])
+        await self._disconnect()
+
+    async def test_downgrade_to_read_rejects_publishing(self):
+        await sync_to_async(self._grant)('reader', [('sensors', 'read')])
+        await sync_to_async(self._grant)('writer', [('sensors', 'readwrite')])
+        reader, _, _ = await self._connect('reader', 'sensors')
+        writer, _, _ = await self._connect('writer', 'sensors')
+        await writer.send_to(text_data=json.dumps({"tag": 'sensors', "message": 'before'}))
+        self.assertEqual(await self._received(reader), [('sensors', 'before')])
+
+        await sync_to_async(self._set_permission)('writer', 'sensors', 'read')
+        # The connection stays open with the new permission applied in place.
+        self.assertTrue(await writer.receive_nothing(0.2))
+        await writer.send_to(text_data=json.dumps({"tag": 'sensors', "message": 'after'}))
+        self.assertEqual(await self._received(reader), [])
+        await self._disconnect()
+
+    async def test_revoke_closes_the_connection(self):
+        await sync_to_async(self._grant)('reader', [('sensors', 'read')])
+        reader, _, _ = await self._connect('reader', 'sensors')
+        await sync_to_async(self._set_permission)('reader', 'sensors', None)
+        output = await reader.receive_output(1)
+        self.assertEqual((output['type'], output['code']), ('websocket.close', 4001))
+        await self._disconnect()
+
+    async def test_rename_that_drops_coverage_closes_the_connection(self):
+        await sync_to_async(self._grant)('reader', [('sensors', 'read')])
+        reader, _, _ = await self._connect('reader', 'sensors')
+        await sync_to_async(self._rename_tag)('sensors', 'devices')
+        output = await reader.receive_output(1)
+        self.assertEqual((output['type'], output['code']), ('websocket.close', 4003))
+        await self._disconnect()
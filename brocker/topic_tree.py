@@ -0,0 +1,419 @@
+import bisect
+import itertools
+
+from brocker.MqttPatternMatcher import MqttPatternMatcher
+
+def literal_prefix(pattern: str) -> str:
+    """
+    Returns the leading levels of a pattern that contain no wildcard, e.g.
+    'sensors/room1' for 'sensors/room1/+/temp' and 'site.a' for
+    'site.a/+/temp'.
+
+    Every topic matched by the pattern starts with these levels. A pattern
+    without wildcards is its own prefix. As in MqttPatternMatcher, '+' is a
+    wildcard wherever it appears and '#' only as the whole last level.
+    """
+    levels = pattern.split('/')
+    last = len(levels) - 1
+    for i, level in enumerate(levels):
+        if '+' in level or (level == '#' and i == last):
+            return '/'.join(levels[:i])
+    return pattern
+
+
+def _level_covers(grant: str, level: str) -> bool:
+    if grant == level:
+        return True
+    if '+' in level:
+        # A wildcard level is only covered by a wildcard at least as wide.
+        return grant == '+'
+    if grant == '+':
+        return bool(level)
+    return '+' in grant and bool(MqttPatternMatcher.compile(grant).match(level))
+
+
+def pattern_covers(grant: str, pattern: str) -> bool:
+    """
+    True when every topic matched by pattern is matched by grant, compared
+    level by level: a '+' level covers a literal or '+' level, a trailing
+    '#' is only covered by '#', and grant may not have more levels than
+    pattern unless the extra one is its trailing '#'.
+
+    A pattern that grant matches as a topic may still match more topics,
+    e.g. 'sensors/+' matches 'sensors/#' but does not cover it.
+    """
+    grant_levels = grant.split('/')
+    levels = pattern.split('/')
+    grant_multi = grant_levels[-1] == '#'
+    if grant_multi:
+        grant_levels.pop()
+    multi = levels[-1] == '#'
+    if multi:
+        levels.pop()
+
+    if grant_multi:
+        if len(levels) < len(grant_levels):
+            return False
+    elif multi or len(levels) != len(grant_levels):
+        return False
+    return all(_level_covers(g, level) for g, level in zip(grant_levels, levels))
+
+
+def _specificity(pattern: str) -> tuple:
+    # Orders patterns the way TopicTree.match prefers them, level by level:
+    # literal, then '+' inside a level, then '+', then '#'.
+    last = pattern.count('/')
+    return tuple(
+        3 if level == '#' and i == last else 2 if level == '+' else 1 if '+' in level else 0
+        for i, level in enumerate(pattern.split('/'))
+    )
+
+
+def level_prefixes(topic: str) -> list[str]:
+    """
+    Returns the empty prefix and every leading run of levels of a topic,
+    e.g. ['', 'a', 'a/b', 'a/b/c'] for 'a/b/c'.
+    """
+    levels = topic.split('/')
+    return [''] + ['/'.join(levels[:i]) for i in range(1, len(levels) + 1)]
+
+
+class _Node:
+    __slots__ = ('children', 'single', 'multi', 'terminal')
+
+    def __init__(self):
+        self.children = {}
+        self.single = None    # child node for the '+' wildcard
+        self.multi = None     # (pattern, value) for a trailing '#' wildcard
+        self.terminal = None  # (pattern, value) for a pattern ending here
+
+
+class TopicTree:
+    """
+    An index of MQTT topic patterns split into levels on '/', with dedicated
+    nodes for the single-level (+) and multi-level (#) wildcards.
+
+    Looking up a topic walks at most one branch per wildcard kind and level,
+    so the cost grows with the topic depth rather than the number of stored
+    patterns. Matching follows MqttPatternMatcher exactly: patterns with a
+    '+' inside a level, such as 'sensor+/temp', are kept aside and checked
+    with the compiled matcher after the tree.
+    """
+
+    def __init__(self, patterns=None):
+        self._root = _Node()
+        self._fallback = {}
+        self._matcher = MqttPatternMatcher()
+        self._size = 0
+        for pattern, value in (patterns or ()):
+            self.insert(pattern, value)
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _is_plain(levels: list[str]) -> bool:
+        last = len(levels) - 1
+        for i, level in enumerate(levels):
+            if level == '+' or (level == '#' and i == last):
+                continue
+            if '+' in level:
+                return False
+        return True
+
+    def insert(self, pattern: str, value=None):
+        """
+        Adds a pattern to the index, replacing the value of an existing entry.
+
+        Args:
+            pattern (str): The MQTT pattern (e.g., 'sensors/+/temp' or 'logs/#').
+            value: Arbitrary data returned alongside the pattern on a match.
+        """
+        levels = pattern.split('/')
+        if not self._is_plain(levels):
+            if pattern not in self._fallback:
+                self._size += 1
+            self._fallback[pattern] = value
+            return
+
+        node = self._root
+        last = len(levels) - 1
+        for i, level in enumerate(levels):
+            if level == '#' and i == last:
+                if node.multi is None:
+                    self._size += 1
+                node.multi = (pattern, value)
+                return
+            if level == '+':
+                if node.single is None:
+                    node.single = _Node()
+                node = node.single
+            else:
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = _Node()
+                node = child
+
+        if node.terminal is None:
+            self._size += 1
+        node.terminal = (pattern, value)
+
+    def remove(self, pattern: str):
+        """
+        Removes a pattern from the index.
+
+        Args:
+            pattern (str): The MQTT pattern to remove.
+
+        Returns:
+            The value stored for the pattern, or None if it was not indexed.
+        """
+        levels = pattern.split('/')
+        if not self._is_plain(levels):
+            if pattern not in self._fallback:
+                return None
+            self._size -= 1
+            return self._fallback.pop(pattern)
+
+        # Remember the path so nodes left empty can be pruned afterwards.
+        path = []
+        node = self._root
+        last = len(levels) - 1
+        for i, level in enumerate(levels):
+            if level == '#' and i == last:
+                if node.multi is None:
+                    return None
+                _, value = node.multi
+                node.multi = None
+                break
+            child = node.single if level == '+' else node.children.get(level)
+            if child is None:
+                return None
+            path.append((node, level))
+            node = child
+        else:
+            if node.terminal is None:
+                return None
+            _, value = node.terminal
+            node.terminal = None
+
+        self._size -= 1
+        while path and not (node.children or node.single or node.multi or node.terminal):
+            node, level = path.pop()
+            if level == '+':
+                node.single = None
+            else:
+                del node.children[level]
+        return value
+
+    def _find(self, node, levels, i):
+        if i == len(levels):
+            return node.terminal or node.multi
+
+        child = node.children.get(levels[i])
+        if child is not None:
+            found = self._find(child, levels, i + 1)
+            if found:
+                return found
+
+        if node.single is not None and levels[i]:
+            found = self._find(node.single, levels, i + 1)
+            if found:
+                return found
+
+        return node.multi
+
+    def match(self, topic: str):
+        """
+        Finds the pattern that matches a topic.
+
+        When several patterns match, literal levels win over '+', and '+'
+        wins over '#'.
+
+        Args:
+            topic (str): The MQTT topic to look up.
+
+        Returns:
+            tuple | None: (pattern, value) for the match, or None.
+        """
+        found = self._find(self._root, topic.split('/'), 0)
+        if found:
+            return found
+
+        if self._fallback:
+            pattern = self._matcher.first_match(topic, list(self._fallback))
+            if pattern is not None:
+                return pattern, self._fallback[pattern]
+        return None
+
+    def match_pattern(self, pattern: str):
+        """
+        Finds the most specific indexed pattern covering every topic that
+        pattern matches (see pattern_covers), for requests that are
+        patterns themselves. A topic is looked up as with match().
+
+        Returns:
+            tuple | None: (pattern, value) for the covering pattern, or None.
+        """
+        if literal_prefix(pattern) == pattern:
+            return self.match(pattern)
+        # A covering pattern matches pattern read as a topic.
+        covering = [found for found in self.match_all(pattern) if pattern_covers(found[0], pattern)]
+        if not covering:
+            return None
+        return min(covering, key=lambda found: _specificity(found[0]))
+
+    def _collect(self, node, levels, i, found):
+        if node.multi is not None:
+            found.append(node.multi)
+        if i == len(levels):
+            if node.terminal is not None:
+                found.append(node.terminal)
+            return
+
+        child = node.children.get(levels[i])
+        if child is not None:
+            self._collect(child, levels, i + 1, found)
+        if node.single is not None and levels[i]:
+            self._collect(node.single, levels, i + 1, found)
+
+    def match_all(self, topic: str) -> list:
+        """
+        Finds every pattern that matches a topic.
+
+        Args:
+            topic (str): The MQTT topic to look up.
+
+        Returns:
+            list: (pattern, value) for each matching pattern, in no particular order.
+        """
+        found = []
+        self._collect(self._root, topic.split('/'), 0, found)
+        compile_pattern = self._matcher.compile
+        for pattern, value in self._fallback.items():
+            if compile_pattern(pattern).match(topic):
+                found.append((pattern, value))
+        return found
+
+    def _collect_below(self, node, found):
+        if node.terminal is not None:
+            found.append(node.terminal)
+        if node.multi is not None:
+            found.append(node.multi)
+        for child in node.children.values():
+            self._collect_below(child, found)
+        if node.single is not None:
+            self._collect_below(node.single, found)
+
+    def _collect_matched_by(self, node, levels, i, found):
+        if i == len(levels):
+            if node.terminal is not None:
+                found.append(node.terminal)
+            return
+        # Stored '+' and trailing '#' levels are read as the topic levels '+'
+        # and '#' here.
+        level = levels[i]
+        last = i == len(levels) - 1
+        if level == '#' and last:
+            self._collect_below(node, found)
+            return
+        # A trailing '#' also matches nothing, making this the last level.
+        ends = last or (i == len(levels) - 2 and levels[-1] == '#')
+        if '+' not in level:
+            child = node.children.get(level)
+            if child is not None:
+                self._collect_matched_by(child, levels, i + 1, found)
+            if node.multi is not None and ends and level == '#':
+                found.append(node.multi)
+            return
+
+        regex = None if level == '+' else self._matcher.compile(level)
+        for key, child in node.children.items():
+            if (regex.match(key) if regex else key):
+                self._collect_matched_by(child, levels, i + 1, found)
+        if node.single is not None and (regex is None or regex.match('+')):
+            self._collect_matched_by(node.single, levels, i + 1, found)
+        if node.multi is not None and ends and (regex is None or regex.match('#')):
+            found.append(node.multi)
+
+    def matched_by(self, pattern: str) -> list:
+        """
+        Finds every indexed pattern that pattern matches when read as a
+        topic, the reverse of match_all(). Walks only the branches pattern
+        can match, rather than every indexed pattern.
+
+        Args:
+            pattern (str): The MQTT pattern to match indexed entries against.
+
+        Returns:
+            list: (pattern, value) for each matched entry, in no particular order.
+        """
+        found = []
+        self._collect_matched_by(self._root, pattern.split('/'), 0, found)
+        if self._fallback:
+            regex = self._matcher.compile(pattern)
+            found.extend((stored, value) for stored, value in self._fallback.items() if regex.match(stored))
+        return found
+
+
+def patterns_overlap(first: str, second: str) -> bool:
+    """
+    True when either pattern matches the other one read as a topic, the
+    rule BrokerTags uses to keep tag prefixes from overlapping.
+    """
+    compile_pattern = MqttPatternMatcher.compile
+    return bool(compile_pattern(first).match(second) or compile_pattern(second).match(first))
+
+
+class PrefixIndex:
+    """
+    A set of patterns indexed for overlap checks.
+
+    A pattern can only overlap patterns whose literal prefix is one of its
+    level prefixes, or patterns that start with its own literal prefix, so a
+    check looks up those two narrow candidate sets instead of every pattern.
+    """
+
+    def __init__(self, patterns=()):
+        self._by_literal = {}
+        self._sorted = sorted(patterns)
+        for pattern in self._sorted:
+            self._by_literal.setdefault(literal_prefix(pattern), []).append(pattern)
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def add(self, pattern: str):
+        bisect.insort(self._sorted, pattern)
+        self._by_literal.setdefault(literal_prefix(pattern), []).append(pattern)
+
+    def _starting_with(self, prefix):
+        start = bisect.bisect_left(self._sorted, prefix)
+        for pattern in itertools.islice(self._sorted, start, None):
+            if not pattern.startswith(prefix):
+                break
+            yield pattern
+
+    def candidates(self, pattern: str):
+        """
+        Yields the indexed patterns that may overlap with pattern.
+        """
+        literal = literal_prefix(pattern)
+        if not literal:
+            yield from self._sorted
+            return
+        for prefix in level_prefixes(pattern):
+            yield from self._by_literal.get(prefix, ())
+        start = bisect.bisect_left(self._sorted, literal)
+        if start < len(self._sorted) and self._sorted[start] == literal:
+            yield literal
+        yield from self._starting_with(literal + '/')
+
+    def find_overlap(self, pattern: str):
+        """
+        Returns an indexed pattern overlapping with pattern, or None.
+        """
+        for candidate in self.candidates(pattern):
+            if patterns_overlap(pattern, candidate):
+                return candidate
+        return None
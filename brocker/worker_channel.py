@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+# channels_redis forgets group members after group_expiry (one day by
+# default), so the worker re-joins its groups well before that.
+GROUP_REFRESH_INTERVAL = 3600
+# Groups re-joined concurrently per step of a refresh.
+REFRESH_BATCH_SIZE = 100
+
+
+class WorkerChannel:
+    """
+    A channel owned by the worker process rather than by a single connection.
+
+    Process-wide components register a handler per message type and join the
+    groups they listen on; a background task receives from the channel and
+    dispatches every message to its handler.
+    """
+
+    def __init__(self):
+        self.channel_name = None
+        self._handlers = {}
+        self._groups = set()
+        self._loop = None
+        self._ready = None
+        self._tasks = []
+
+    @property
+    def loop(self):
+        """The event loop the channel was started on, if any."""
+        return self._loop
+
+    def register(self, message_type, handler):
+        self._handlers[message_type] = handler
+
+    async def start(self):
+        """
+        Start receiving on the running event loop. Returns False when no
+        channel layer is configured.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            await self._ready.wait()
+            return self.channel_name is not None
+
+        self._loop = loop
+        self._ready = asyncio.Event()
+        self.channel_name = None
+        try:
+            channel_layer = get_channel_layer()
+            if channel_layer is None:
+                return False
+
+            channel_name = await channel_layer.new_channel("worker")
+            await asyncio.gather(*(
+                channel_layer.group_add(group, channel_name) for group in list(self._groups)
+            ))
+            self._tasks = [
+                loop.create_task(self._receive_loop(channel_layer, channel_name)),
+                loop.create_task(self._refresh_loop(channel_layer, channel_name)),
+            ]
+            self.channel_name = channel_name
+            logger.debug("Worker channel started: %s", channel_name)
+            return True
+        except Exception:
+            self._loop = None
+            raise
+        finally:
+            self._ready.set()
+
+    async def group_add(self, group):
+        """
+        Join a group. Cheap when this worker is already a member.
+        """
+        started = self._loop is asyncio.get_running_loop()
+        if started and group in self._groups:
+            return
+        self._groups.add(group)
+        # A fresh start joins every known group itself.
+        if started and await self.start():
+            await get_channel_layer().group_add(group, self.channel_name)
+        elif not started:
+            await self.start()
+
+    async def group_discard(self, group):
+        self._groups.discard(group)
+        if self.channel_name and self._loop is asyncio.get_running_loop():
+            await get_channel_layer().group_discard(group, self.channel_name)
+
+    async def _receive_loop(self, channel_layer, channel_name):
+        while True:
+            message = await channel_layer.receive(channel_name)
+            handler = self._handlers.get(message.get("type"))
+            if handler is None:
+                logger.warning("Worker channel got unknown message type: %s", message.get("type"))
+                continue
+            try:
+                await handler(message)
+            except Exception:
+                logger.exception("Worker channel handler failed for %s", message.get("type"))
+
+    async def _refresh_loop(self, channel_layer, channel_name):
+        while True:
+            await asyncio.sleep(GROUP_REFRESH_INTERVAL)
+            groups = list(self._groups)
+            for start in range(0, len(groups), REFRESH_BATCH_SIZE):
+                await asyncio.gather(*(
+                    channel_layer.group_add(group, channel_name)
+                    for group in groups[start:start + REFRESH_BATCH_SIZE]
+                ))
+
+
+worker_channel = WorkerChannel()
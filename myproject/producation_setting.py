@@ -70,12 +70,18 @@ CACHES = {
     }
 }
 
+# === Connection accounting (Redis) ===
+BROCKER_REDIS_URL = os.environ.get("REDIS_URL", "") + "1"
+
 # === Channels (Redis) ===
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
             "hosts": [os.environ.get("REDIS_URL", "") + "0"],  
+            # Each worker channel receives the messages of every tag its
+            # sockets subscribe to.
+            "channel_capacity": {"worker.*": 10000},
         },
     },
 }